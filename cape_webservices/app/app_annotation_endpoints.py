@@ -17,6 +17,7 @@ from hashlib import sha256
 from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_annotation_endpoints
 from cape_webservices.app.app_middleware import respond_with_json, requires_auth
+from cape_webservices.app.app_answer_cache import invalidates_answer_cache
 from cape_document_manager.annotation_store import AnnotationStore
 from cape_api_helpers.output import list_response
 from cape_api_helpers.input import required_parameter, optional_parameter, list_annotation_ids, list_document_ids, \
@@ -53,6 +54,7 @@ def _get_annotations(request, number_of_items=30, offset=0, annotation_ids=None,
 @respond_with_json
 @dict_metadata
 @requires_auth
+@invalidates_answer_cache
 def _add_annotation(request, metadata=None):
     question = required_parameter(request, 'question')
     answer = required_parameter(request, 'answer')
@@ -75,6 +77,7 @@ def _add_annotation(request, metadata=None):
 @_endpoint_route('/annotations/delete-annotation')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_annotation(request):
     annotation_id = required_parameter(request, 'annotationId')
     return AnnotationStore.delete_annotation(request['user'].token, annotation_id)
@@ -83,6 +86,7 @@ def _delete_annotation(request):
 @_endpoint_route('/annotations/edit-canonical-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_canonical_question(request):
     annotation_id = required_parameter(request, 'annotationId')
     question = required_parameter(request, 'question')
@@ -92,6 +96,7 @@ def _edit_canonical_question(request):
 @_endpoint_route('/annotations/add-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _add_paraphrase_question(request):
     annotation_id = required_parameter(request, 'annotationId')
     question = required_parameter(request, 'question')
@@ -101,6 +106,7 @@ def _add_paraphrase_question(request):
 @_endpoint_route('/annotations/edit-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_paraphrase_question(request):
     question_id = required_parameter(request, 'questionId')
     question = required_parameter(request, 'question')
@@ -110,6 +116,7 @@ def _edit_paraphrase_question(request):
 @_endpoint_route('/annotations/delete-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_paraphrase_question(request):
     question_id = required_parameter(request, 'questionId')
     return AnnotationStore.delete_paraphrase_question(request['user'].token, question_id)
@@ -118,6 +125,7 @@ def _delete_paraphrase_question(request):
 @_endpoint_route('/annotations/add-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _add_answer(request):
     annotation_id = required_parameter(request, 'annotationId')
     answer = required_parameter(request, 'answer')
@@ -127,6 +135,7 @@ def _add_answer(request):
 @_endpoint_route('/annotations/edit-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_answer(request):
     answer_id = required_parameter(request, 'answerId')
     answer = required_parameter(request, 'answer')
@@ -136,6 +145,7 @@ def _edit_answer(request):
 @_endpoint_route('/annotations/delete-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_answer(request):
     answer_id = required_parameter(request, 'answerId')
     return AnnotationStore.delete_answer(request['user'].token, answer_id)
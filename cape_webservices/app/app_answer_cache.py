@@ -0,0 +1,244 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha256
+from secrets import token_urlsafe
+from threading import Lock, Event
+from typing import Optional, List, Tuple
+
+from cape_webservices.app.app_content_totals import content_totals
+from cape_webservices.webservices_settings import ANSWER_CACHE_MAX_SIZE, ANSWER_CURSOR_MAX_SIZE, ANSWER_CURSOR_TTL
+
+
+class AnswerCache:
+    """LRU cache of /answer results, invalidated per user when their documents or saved replies change."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        # Incremented on every invalidation so answers computed before a change are never stored
+        self._generations = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(user_token, question, source_type, text, speed_or_accuracy, saved_reply_threshold, document_threshold,
+            document_ids, offset, number_of_items, concurrent_sources=False, **kwargs) -> Tuple:
+        """Build the cache key from the /answer parameters."""
+        if text is not None:
+            text = sha256(text.encode('utf-8')).hexdigest()
+        if document_ids is not None:
+            document_ids = tuple(sorted(document_ids))
+        return (user_token, ' '.join(question.lower().split()), source_type, text, speed_or_accuracy,
+                str(saved_reply_threshold).lower(), str(document_threshold).lower(), document_ids, offset,
+                number_of_items, concurrent_sources)
+
+    def generation(self, user_token: str) -> int:
+        with self._lock:
+            return self._generations.get(user_token, 0)
+
+    def get(self, key: Tuple) -> Optional[List[dict]]:
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(results)
+
+    def set(self, key: Tuple, results: List[dict], generation: int):
+        """Store results computed while the user's data was at the given generation."""
+        if self.max_size <= 0:
+            return
+        user_token = key[0]
+        with self._lock:
+            if self._generations.get(user_token, 0) != generation:
+                return
+            self._entries[key] = list(results)
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(user_token, set()).add(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._discard_user_key(evicted_key)
+                self.evictions += 1
+
+    def invalidate(self, user_token: str):
+        with self._lock:
+            self._generations[user_token] = self._generations.get(user_token, 0) + 1
+            for key in self._keys_by_user.pop(user_token, ()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'maxSize': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _discard_user_key(self, key: Tuple):
+        user_keys = self._keys_by_user.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user[key[0]]
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_SIZE)
+
+
+def invalidates_answer_cache(wrapped):
+    """Decorator for endpoints modifying the documents, annotations or saved replies of the logged in user, also
+    recounting their content for the statistics."""
+
+    if asyncio.iscoroutinefunction(wrapped):
+        @wraps(wrapped)
+        async def decorated(request, *args, **kwargs):
+            try:
+                return await wrapped(request, *args, **kwargs)
+            finally:
+                answer_cache.invalidate(request['user'].token)
+                content_totals.invalidate(request['user'].token)
+
+        return decorated
+
+    @wraps(wrapped)
+    def decorated(request, *args, **kwargs):
+        try:
+            return wrapped(request, *args, **kwargs)
+        finally:
+            answer_cache.invalidate(request['user'].token)
+            content_totals.invalidate(request['user'].token)
+
+    return decorated
+
+
+class AnswerCursors:
+    """Ranked answers kept server side for a while so following pages are served without the responder."""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        # cursor id -> (user token, expiry time, answers, extra response fields), oldest first
+        self._cursors = OrderedDict()
+        self._lock = Lock()
+
+    def create(self, user_token: str, results: List[dict], **fields) -> Optional[str]:
+        """Keep the answers for paging, returning the cursor id or None when cursors are disabled."""
+        if self.max_size <= 0 or self.ttl <= 0:
+            return None
+        cursor_id = token_urlsafe(16)
+        with self._lock:
+            self._cursors[cursor_id] = (user_token, time.time() + self.ttl, list(results), fields)
+            now = time.time()
+            while self._cursors:
+                oldest_id, (_, expiry, _, _) = next(iter(self._cursors.items()))
+                if expiry > now and len(self._cursors) <= self.max_size:
+                    break
+                del self._cursors[oldest_id]
+        return cursor_id
+
+    def page(self, cursor_id: str, user_token: str, offset: int, number_of_items: int) -> Optional[dict]:
+        """Return a page of the cursor's answers, None if the cursor expired or belongs to another user."""
+        with self._lock:
+            cursor = self._cursors.get(cursor_id)
+        if cursor is None or cursor[0] != user_token or cursor[1] <= time.time():
+            return None
+        _, _, results, fields = cursor
+        return {'items': results[offset:offset + number_of_items], 'cursorId': cursor_id,
+                'totalItems': len(results), **fields}
+
+
+answer_cursors = AnswerCursors(ANSWER_CURSOR_MAX_SIZE, ANSWER_CURSOR_TTL)
+
+
+class _Computation:
+
+    def __init__(self, deadline: Optional[float]):
+        self.deadline = deadline
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _later(deadline: Optional[float], other: Optional[float]) -> bool:
+    """Whether a deadline passes after the other one, None meaning no deadline."""
+    if deadline is None:
+        return other is not None
+    return other is not None and deadline > other
+
+
+class AnswerCoalescer:
+    """Lets identical concurrent /answer requests share a single computation."""
+
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = Lock()
+        self.computed = 0
+        self.coalesced = 0
+
+    def run(self, key: Tuple, compute, deadline: Optional[float] = None):
+        """Return compute(), the answers and whether they are partial, or the result of the computation already in
+        flight for the same key.
+
+        Requests only wait for computations ending before their own deadline, and compute the answers themselves when
+        the ones they waited for were cut short by an earlier deadline.
+        """
+        with self._lock:
+            computation = self._in_flight.get(key)
+            if computation is not None and not _later(computation.deadline, deadline):
+                self.coalesced += 1
+            else:
+                computation = None
+        if computation is not None:
+            computation.done.wait()
+            if computation.error is not None:
+                raise computation.error
+            if not computation.result[1] or computation.deadline == deadline:
+                return computation.result
+        return self._compute(key, compute, deadline)
+
+    def _compute(self, key, compute, deadline):
+        computation = _Computation(deadline)
+        with self._lock:
+            # A computation with a later deadline is already in flight, this one is not shared
+            leader = key not in self._in_flight
+            if leader:
+                self._in_flight[key] = computation
+            self.computed += 1
+        try:
+            computation.result = compute()
+            return computation.result
+        except Exception as e:
+            computation.error = e
+            raise
+        finally:
+            if leader:
+                with self._lock:
+                    del self._in_flight[key]
+                computation.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'inFlight': len(self._in_flight), 'computed': self.computed, 'coalesced': self.coalesced}
+
+
+answer_coalescer = AnswerCoalescer()
@@ -0,0 +1,58 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Tuple
+
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.document_store import DocumentStore
+from cape_webservices.webservices_settings import CONTENT_TOTALS_CACHE_SIZE
+
+
+class ContentTotals:
+    """Number of saved replies and documents of the users, kept until their content changes with LRU eviction."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # user token -> (number of saved replies, number of documents), least recently used first
+        self._totals = OrderedDict()
+        # Incremented on every invalidation so totals counted before a change are never stored
+        self._invalidations = 0
+        self._lock = Lock()
+
+    def get(self, user_token: str) -> Tuple[int, int]:
+        with self._lock:
+            totals = self._totals.get(user_token)
+            if totals is not None:
+                self._totals.move_to_end(user_token)
+                return totals
+            invalidations = self._invalidations
+        # The document manager only lists documents and saved replies, it has no count
+        totals = (len(AnnotationStore.get_annotations(user_token, saved_replies=True)),
+                  len(DocumentStore.get_documents(user_token)))
+        with self._lock:
+            if self.max_size > 0 and invalidations == self._invalidations:
+                self._totals[user_token] = totals
+                while len(self._totals) > self.max_size:
+                    self._totals.popitem(last=False)
+        return totals
+
+    def invalidate(self, user_token: str):
+        with self._lock:
+            self._totals.pop(user_token, None)
+            self._invalidations += 1
+
+
+content_totals = ContentTotals(CONTENT_TOTALS_CACHE_SIZE)
@@ -12,28 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import json
 import os
 import time
+from logging import warning
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+from typing import Tuple, Optional
 
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.input import required_parameter, optional_parameter, list_document_ids
 from cape_api_helpers.output import list_response, debuggable
 from cape_api_helpers.text_responses import *
+from cape_api_helpers.headers import generate_cors_headers
+from sanic.response import stream
 
 from cape_responder.responder_core import Responder
+from cape_document_manager.document_store import DocumentStore
 from cape_webservices.webservices_settings import MAX_SIZE_INLINE_TEXT, \
-    HOSTNAME, CONFIG_SERVER, MAX_NUMBER_OF_ANSWERS
+    HOSTNAME, CONFIG_SERVER, MAX_NUMBER_OF_ANSWERS, ANSWER_EXECUTOR_THREADS, ANSWER_CONCURRENT_SOURCES, \
+    SAVED_REPLY_SHORTCUT_CONFIDENCE, MAX_BATCH_QUESTIONS, ANSWER_PLAN_DEADLINES_MS, ANSWER_MAX_DEADLINE_MS, \
+    ANSWER_BATCH_THREADS
 from cape_responder.task_manager import connect
-from cape_webservices.app.app_middleware import respond_with_json, requires_token
+from cape_userdb.base import DB
+from cape_webservices.app.app_middleware import respond_with_json, async_respond_with_json, requires_token
 from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_endpoints
-from cape_userdb.base import DB
-from cape_userdb.event import Event
-from cape_userdb.coverage import Coverage
+from cape_webservices.app.app_answer_cache import answer_cache, AnswerCache, answer_cursors, answer_coalescer
+from cape_webservices.app.app_load_control import answer_load_controller, responder_calls
+from cape_webservices.app.app_inline_text_cache import inline_text_cache, INLINE_TEXT_USER
+from cape_webservices.app.app_document_jobs import document_jobs
+# store_event is still imported from here by the bot plugins
+from cape_webservices.events.events_core import store_event
+from cape_webservices.events.events_writer import event_writer
 
 _endpoint_route = lambda x: app_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
+ERROR_INVALID_QUESTIONS = "Parameter 'questions' must be a non empty JSON list of questions"
+ERROR_TOO_MANY_QUESTIONS = "A maximum of %d questions can be answered at once, received %d"
+ERROR_INVALID_CURSOR = "Answer cursor '%s' does not exist or has expired"
+ERROR_INVALID_DEADLINE = "Parameter 'deadlineMs' must be a positive number of milliseconds, received '%s'"
+
+# Responder calls block on dask results, the asynchronous endpoints answer questions here
+_answer_executor = ThreadPoolExecutor(max_workers=ANSWER_EXECUTOR_THREADS)
+# Batches of up to MAX_BATCH_QUESTIONS questions are answered here so that they never hold up the other answers
+_batch_executor = ThreadPoolExecutor(max_workers=ANSWER_BATCH_THREADS)
+
 
 def square(x):
     return x ** 2
@@ -43,21 +68,6 @@ def neg(x):
     return -x
 
 
-def store_event(user_id, question, answers, question_source, answered, duration, automatic=False):
-    if DB.is_closed():
-        DB.connect()
-    event = Event(user_id=user_id, question=question, question_source=question_source, answers=answers,
-                  answered=answered, duration=duration, automatic=automatic)
-    event.save()
-    total = Event.select().where(Event.user_id == user_id).count()
-    automatic = Event.select().where(Event.user_id == user_id, Event.automatic == True).count()
-    # Base line of 60% from MR plus proportion answered by saved replies
-    coverage = 60 + (automatic / total) * 35
-    coverage_stat = Coverage(user_id=user_id, coverage=coverage)
-    coverage_stat.save()
-    DB.close()
-
-
 @_endpoint_route('/test')
 @debuggable
 @respond_with_json
@@ -70,22 +80,21 @@ def _test(request):
             'hostname': HOSTNAME, 'port': CONFIG_SERVER['port']}
 
 
-@_endpoint_route('/answer')
-@debuggable
-@respond_with_json
-@list_response
-@list_document_ids
-@requires_token
-def _answer(request, number_of_items=1, offset=0, document_ids=None, max_number_of_answers=MAX_NUMBER_OF_ANSWERS):
-    start_time = time.time()
+def _answer_parameters(request, number_of_items, offset, document_ids, max_number_of_answers, question=None) -> dict:
+    """Validate the /answer parameters and return them as keyword arguments for the answering functions."""
     number_of_items = min(number_of_items, max(0, max_number_of_answers - offset))
     user_token = required_parameter(request, 'token')
-    question = required_parameter(request, 'question')
+    if question is None:
+        question = required_parameter(request, 'question')
     source_type = optional_parameter(request, 'sourceType', 'all').lower()
     text = optional_parameter(request, 'text', None)
     speed_or_accuracy = optional_parameter(request, 'speedOrAccuracy', 'balanced').lower()
     saved_reply_threshold = optional_parameter(request, 'threshold', request['user_from_token'].saved_reply_threshold)
     document_threshold = optional_parameter(request, 'threshold', request['user_from_token'].document_threshold)
+    concurrent_sources = str(optional_parameter(request, 'concurrentSources', ANSWER_CONCURRENT_SOURCES)).lower()
+    deadline_ms = str(optional_parameter(request, 'deadlineMs',
+                                         ANSWER_PLAN_DEADLINES_MS.get(request['user_from_token'].plan,
+                                                                      ANSWER_MAX_DEADLINE_MS)))
     if source_type not in {'document', 'saved_reply', 'all'}:
         raise UserException(ERROR_INVALID_SOURCE_TYPE)
     if speed_or_accuracy not in {'speed', 'accuracy', 'balanced', 'total'}:
@@ -93,42 +102,318 @@ def _answer(request, number_of_items=1, offset=0, document_ids=None, max_number_
     else:
         if request['user_from_token'].plan == "pro":
             speed_or_accuracy = "total"
+        speed_or_accuracy = answer_load_controller.choose(speed_or_accuracy, request['user_from_token'].plan)
     if text is not None and len(text) > MAX_SIZE_INLINE_TEXT:
         raise UserException(ERROR_MAX_SIZE_INLINE_TEXT % (MAX_SIZE_INLINE_TEXT, len(text)))
+    if not deadline_ms.isnumeric() or int(deadline_ms) <= 0:
+        raise UserException(ERROR_INVALID_DEADLINE % deadline_ms)
+    return {'user_token': user_token, 'question': question, 'source_type': source_type, 'text': text,
+            'speed_or_accuracy': speed_or_accuracy, 'saved_reply_threshold': saved_reply_threshold,
+            'document_threshold': document_threshold, 'document_ids': document_ids, 'offset': offset,
+            'number_of_items': number_of_items, 'concurrent_sources': concurrent_sources == 'true',
+            'deadline': time.time() + min(int(deadline_ms), ANSWER_MAX_DEADLINE_MS) / 1000}
+
+
+def _get_document_answers(user_token, question, document_ids, offset, number_of_items, text, document_threshold,
+                          speed_or_accuracy) -> list:
+    """Responder.get_answers_from_documents, reading inline texts from their cached processed document and leaving out
+    the documents still processed in the background."""
+    if text is None:
+        pending = document_jobs.pending_documents(user_token)
+        if pending:
+            if document_ids is None:
+                document_ids = [document['id'] for document in DocumentStore.get_documents(user_token)]
+            document_ids = [document_id for document_id in document_ids if document_id not in pending]
+            if not document_ids:
+                return []
+    elif inline_text_cache.enabled:
+        with inline_text_cache.document(text) as document_id:
+            return Responder.get_answers_from_documents(INLINE_TEXT_USER, question, [document_id], offset,
+                                                        number_of_items, None, document_threshold, speed_or_accuracy)
+    return Responder.get_answers_from_documents(user_token, question, document_ids, offset, number_of_items, text,
+                                                document_threshold, speed_or_accuracy)
+
+
+def _saved_replies_suffice(results, offset, number_of_items) -> bool:
+    """Whether the sorted saved reply results fill the requested page confidently enough to skip the documents."""
+    needed = offset + number_of_items
+    return len(results) >= needed and (needed == 0 or
+                                       results[needed - 1]['confidence'] >= SAVED_REPLY_SHORTCUT_CONFIDENCE)
+
+
+class _DeadlineExceeded(Exception):
+    """Raised when the deadline of a request expires, with the best answers found so far."""
+
+    def __init__(self, results):
+        super().__init__()
+        self.results = results
+
+
+def _start_call(fn, *args, results=()):
+    """Start a responder call, raising _DeadlineExceeded right away when the threads are all taken by calls that
+    outlived their deadline."""
+    future = responder_calls.submit(fn, *args)
+    if future is None:
+        raise _DeadlineExceeded(list(results))
+    return future
+
+
+def _until_deadline(future, deadline, results=()):
+    """Wait for a responder call, abandoning it and raising _DeadlineExceeded if the deadline passes first.
+
+    A call already running is not interrupted, it finishes in the background."""
+    try:
+        return future.result(None if deadline is None else max(0, deadline - time.time()))
+    except FutureTimeoutError:
+        responder_calls.abandon(future)
+        raise _DeadlineExceeded(list(results))
+
+
+def _get_answers(user_token, question, source_type, text, speed_or_accuracy, saved_reply_threshold,
+                 document_threshold, document_ids, offset, number_of_items, concurrent_sources=False,
+                 deadline=None, on_saved_replies=None) -> list:
+    """Answer a question, raising _DeadlineExceeded with the answers found so far once the deadline passes.
+
+    on_saved_replies is called with the saved replies of the page as soon as they are found.
+    """
+    concurrent_sources = concurrent_sources and source_type == 'all'
+    documents = None
+    if concurrent_sources:
+        documents = _start_call(_get_document_answers, user_token, question, document_ids, 0,
+                                offset + number_of_items, text, document_threshold, speed_or_accuracy)
     results = []
 
     if source_type != 'document':
-        results.extend(Responder.get_answers_from_similar_questions(user_token, question, source_type, document_ids,
-                                                                    saved_reply_threshold))
+        try:
+            results.extend(_until_deadline(_start_call(
+                Responder.get_answers_from_similar_questions, user_token, question, source_type, document_ids,
+                saved_reply_threshold), deadline))
+        except Exception:
+            if documents is not None:
+                responder_calls.abandon(documents)
+            raise
 
     results = sorted(results, key=lambda x: x['confidence'],
                      reverse=True)
+    if on_saved_replies is not None and results:
+        on_saved_replies(results[offset:offset + number_of_items])
+
+    if concurrent_sources:
+        if _saved_replies_suffice(results, offset, number_of_items):
+            # A document search already running is not interrupted, it only stops counting against this answer
+            responder_calls.abandon(documents)
+        else:
+            results = sorted(results + _until_deadline(documents, deadline, results[offset:offset + number_of_items]),
+                             key=lambda x: x['confidence'], reverse=True)
+    elif (source_type == 'document' or source_type == 'all') and len(results) < number_of_items:
+        page = results[offset:offset + number_of_items]
+        results.extend(_until_deadline(_start_call(
+            _get_document_answers, user_token, question, document_ids, offset, number_of_items - len(results), text,
+            document_threshold, speed_or_accuracy, results=page), deadline, page))
+
+    return results[offset:offset + number_of_items]
 
-    if (source_type == 'document' or source_type == 'all') and len(results) < number_of_items:
-        results.extend(Responder.get_answers_from_documents(user_token,
-                                                            question,
-                                                            document_ids,
-                                                            offset,
-                                                            number_of_items - len(results),
-                                                            text, document_threshold, speed_or_accuracy))
 
-    results = results[offset:offset + number_of_items]
+def _answers_until_deadline(parameters, on_saved_replies=None) -> Tuple[list, bool]:
+    """Return the answers and whether they are partial because the deadline expired."""
+    try:
+        with answer_load_controller.track():
+            return _get_answers(**parameters, on_saved_replies=on_saved_replies), False
+    except _DeadlineExceeded as e:
+        return e.results, True
 
-    automatic = False
-    if len(results) > 0:
-        automatic = results[0]['sourceType'] == 'saved_reply' or results[0]['sourceType'] == 'annotation'
 
+def _get_cached_answers(parameters) -> Tuple[list, bool]:
+    """Same as _answers_until_deadline, partial answers aren't cached.
+
+    Identical requests arriving while the answers are computed share the computation when its deadline is earlier.
+    """
+    cache_key = AnswerCache.key(**parameters)
+    results = answer_cache.get(cache_key)
+    if results is not None:
+        return results, False
+
+    def compute():
+        generation = answer_cache.generation(parameters['user_token'])
+        computed, partial_results = _answers_until_deadline(parameters)
+        if not partial_results:
+            answer_cache.set(cache_key, computed, generation)
+        return computed, partial_results
+
+    results, partial_results = answer_coalescer.run(cache_key, compute, parameters['deadline'])
+    return list(results), partial_results
+
+
+def _is_automatic(results) -> bool:
+    return len(results) > 0 and (results[0]['sourceType'] == 'saved_reply' or
+                                 results[0]['sourceType'] == 'annotation')
+
+
+def _save_answer_event(request, question, results, start_time):
     duration = time.time() - start_time
-    connect().submit(store_event,
-                     request['user_from_token'].user_id,
-                     question,
-                     results,
-                     'API',
-                     len(results) > 0,
-                     duration,
-                     automatic)
-
-    return {'items': results}
+    event_writer.write(request['user_from_token'].user_id,
+                       question,
+                       results,
+                       'API',
+                       len(results) > 0,
+                       duration,
+                       _is_automatic(results))
+
+
+def _wants_cursor(request) -> bool:
+    return str(optional_parameter(request, 'cursor', 'false')).lower() == 'true'
+
+
+def _cursor_page(request, offset, number_of_items) -> Optional[dict]:
+    """Return the requested page of a previous answer cursor, None if the request doesn't have a cursorId."""
+    cursor_id = optional_parameter(request, 'cursorId', None)
+    if cursor_id is None:
+        return None
+    page = answer_cursors.page(cursor_id, request['user_from_token'].token, offset, number_of_items)
+    if page is None:
+        raise UserException(ERROR_INVALID_CURSOR % cursor_id)
+    return page
+
+
+def _cursor_or_page_parameters(request, number_of_items, offset, document_ids, max_number_of_answers) -> dict:
+    """A new cursor ranks all the answers that can be paged through, otherwise only the requested page is needed."""
+    if _wants_cursor(request):
+        return _answer_parameters(request, max_number_of_answers, 0, document_ids, max_number_of_answers)
+    return _answer_parameters(request, number_of_items, offset, document_ids, max_number_of_answers)
+
+
+def _answer_response(request, parameters, results, partial_results, offset, number_of_items) -> dict:
+    fields = {'speedOrAccuracy': parameters['speed_or_accuracy'], 'partial': partial_results}
+    if _wants_cursor(request):
+        cursor_id = answer_cursors.create(parameters['user_token'], results, **fields)
+        page = None
+        if cursor_id is not None:
+            page = answer_cursors.page(cursor_id, parameters['user_token'], offset, number_of_items)
+        if page is not None:
+            return page
+        # Cursors are disabled, all the answers were ranked so the requested page is still served
+        return {'items': results[offset:offset + number_of_items], 'totalItems': len(results), **fields}
+    return {'items': results, **fields}
+
+
+@debuggable
+@respond_with_json
+@list_response
+@list_document_ids
+@requires_token
+def _answer(request, number_of_items=1, offset=0, document_ids=None, max_number_of_answers=MAX_NUMBER_OF_ANSWERS):
+    """Blocking /answer, called in process by the bots and from the answer executor by the endpoint."""
+    page = _cursor_page(request, offset, number_of_items)
+    if page is not None:
+        return page
+    start_time = time.time()
+    parameters = _cursor_or_page_parameters(request, number_of_items, offset, document_ids, max_number_of_answers)
+    results, partial_results = _get_cached_answers(parameters)
+    response = _answer_response(request, parameters, results, partial_results, offset, number_of_items)
+    _save_answer_event(request, parameters['question'], response['items'], start_time)
+    return response
+
+
+def _answer_in_executor(request):
+    try:
+        return _answer(request)
+    finally:
+        # The user may have been loaded with this thread's connection
+        DB.close()
+
+
+@_endpoint_route('/answer')
+async def _answer_async(request):
+    """Wait for _answer in the executor so the event loop keeps serving requests."""
+    return await asyncio.get_event_loop().run_in_executor(_answer_executor, _answer_in_executor, request)
+
+
+@_endpoint_route('/answer-stream')
+@list_response
+@list_document_ids
+@requires_token
+async def _answer_stream(request, number_of_items=1, offset=0, document_ids=None,
+                         max_number_of_answers=MAX_NUMBER_OF_ANSWERS):
+    """Stream answers as JSON lines, saved replies first and document answers once the reader returns them.
+
+    Saved replies streamed early stay in the response even when document answers outrank them, the last line counts
+    every answer written and the inbox event records the same answers."""
+    start_time = time.time()
+    parameters = _answer_parameters(request, number_of_items, offset, document_ids, max_number_of_answers)
+    # Documents are searched while waiting for the saved replies
+    parameters['concurrent_sources'] = True
+    loop = asyncio.get_event_loop()
+
+    async def streaming_fn(response):
+        written = []
+
+        def write_answers(answers):
+            for answer in answers:
+                if answer not in written:
+                    written.append(answer)
+                    response.write(json.dumps({'answer': answer}) + '\n')
+
+        try:
+            results, partial_results = await loop.run_in_executor(_answer_executor, partial(
+                _answers_until_deadline, parameters,
+                on_saved_replies=lambda answers: loop.call_soon_threadsafe(write_answers, answers)))
+        except UserException as e:
+            response.write(json.dumps({'success': False, 'result': {'message': e.message}}) + '\n')
+            return
+        except Exception:
+            warning("Exception in API", exc_info=True)
+            response.write(json.dumps({'success': False, 'result': {'message': ERROR_TEXT}}) + '\n')
+            return
+        write_answers(results)
+        response.write(json.dumps({'success': True, 'done': True, 'totalItems': len(written),
+                                   'speedOrAccuracy': parameters['speed_or_accuracy'],
+                                   'partial': partial_results}) + '\n')
+        # The event writer waits while it is behind
+        await loop.run_in_executor(None, _save_answer_event, request, parameters['question'], written, start_time)
+
+    return stream(streaming_fn, headers=generate_cors_headers(request), content_type='application/x-ndjson')
+
+
+@_endpoint_route('/answer-batch')
+@async_respond_with_json
+@list_response
+@list_document_ids
+@requires_token
+async def _answer_batch(request, number_of_items=1, offset=0, document_ids=None,
+                        max_number_of_answers=MAX_NUMBER_OF_ANSWERS):
+    """Answer a list of questions sharing the same parameters on the threads reserved for batches."""
+    try:
+        questions = json.loads(required_parameter(request, 'questions'))
+    except ValueError:
+        raise UserException(ERROR_INVALID_QUESTIONS)
+    if not isinstance(questions, list) or not questions or \
+            not all(isinstance(question, str) and question.strip() for question in questions):
+        raise UserException(ERROR_INVALID_QUESTIONS)
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise UserException(ERROR_TOO_MANY_QUESTIONS % (MAX_BATCH_QUESTIONS, len(questions)))
+    all_parameters = [_answer_parameters(request, number_of_items, offset, document_ids, max_number_of_answers,
+                                         question=question) for question in questions]
+    start_time = time.time()
+    loop = asyncio.get_event_loop()
+
+    def timed_answers(parameters):
+        results, partial_results = _get_cached_answers(parameters)
+        return results, partial_results, time.time() - start_time
+
+    answered = await asyncio.gather(*[loop.run_in_executor(_batch_executor, timed_answers, parameters)
+                                      for parameters in all_parameters])
+
+    def save_events():
+        for question, (results, _, duration) in zip(questions, answered):
+            event_writer.write(request['user_from_token'].user_id, question, results, 'API', len(results) > 0,
+                               duration, _is_automatic(results))
+
+    # The event writer waits while it is behind
+    await loop.run_in_executor(None, save_events)
+    return {'items': [{'question': question, 'answers': results, 'speedOrAccuracy': parameters['speed_or_accuracy'],
+                       'partial': partial_results}
+                      for question, parameters, (results, partial_results, _) in
+                      zip(questions, all_parameters, answered)]}
 
 
 if __name__ == '__main__':
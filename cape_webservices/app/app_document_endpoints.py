@@ -12,62 +12,249 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from hashlib import sha256
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import List, Tuple
 
 from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_document_endpoints
 
 from cape_document_manager.document_store import DocumentStore
 
-from cape_webservices.app.app_middleware import respond_with_json, requires_auth
+from cape_webservices.app.app_middleware import respond_with_json, async_respond_with_json, requires_auth
+from cape_webservices.app.app_answer_cache import invalidates_answer_cache
+from cape_webservices.app.app_document_jobs import document_jobs
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.output import list_response
 from cape_api_helpers.input import required_parameter, optional_parameter, list_document_ids
 from cape_api_helpers.text_responses import *
-from cape_responder.responder_core import Responder
+from cape_webservices.app.app_embedding_cache import embedding_cache
+from cape_webservices.webservices_settings import DOCUMENT_UPLOAD_SPOOL_SIZE, DOCUMENT_IMPORT_THREADS, \
+    DOCUMENT_IMPORT_MAX_FILES, DOCUMENT_IMPORT_MAX_SIZE, DOCUMENT_IMPORT_BACKGROUND_SIZE
 
 _endpoint_route = lambda x: app_document_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
+ERROR_INVALID_DOCUMENT_ENCODING = "The document could not be decoded, it must be UTF-8 text"
+ERROR_DOCUMENT_JOBS_FULL = "Too many documents are being processed, please try again later"
+ERROR_DOCUMENT_JOB_DOES_NOT_EXIST = "Document job '%s' does not exist"
+ERROR_INVALID_ARCHIVE = "Could not read the archive '%s'"
+ERROR_TOO_MANY_DOCUMENTS = "At most %d documents can be imported at once"
+ERROR_IMPORT_TOO_LARGE = "At most %d bytes can be imported at once"
+
+_ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2')
+
+_import_executor = ThreadPoolExecutor(DOCUMENT_IMPORT_THREADS)
+
+
+def _create_document(request, document_content, document_type, content_hash) -> dict:
+    """Create the document from the content and the request parameters, in the background when requested.
+
+    content_hash computes the sha256 of the content, used as id when no documentId is given."""
+    user_token = request['user'].token
+    title = required_parameter(request, 'title')
+    if 'documentid' in request['args'] and request['args']['documentid'] != '':
+        document_id = request['args']['documentid']
+    else:
+        document_id = content_hash().hexdigest()
+
+    if 'origin' in request['args'] and request['args']['origin'] != '':
+        origin = request['args']['origin']
+    else:
+        origin = ''
+
+    document_type = optional_parameter(request, 'type', document_type)
+    replace = 'replace' in request['args'] and request['args']['replace'].lower() == 'true'
+    background = optional_parameter(request, 'background', 'false').lower() == 'true'
+
+    document = {'user_id': user_token, 'document_id': document_id, 'title': title, 'text': document_content,
+                'origin': origin, 'document_type': document_type, 'replace': replace}
+    if background:
+        job_id = document_jobs.submit(user_token, document)
+        if job_id is None:
+            raise UserException(ERROR_DOCUMENT_JOBS_FULL)
+        return {'documentId': document_id, 'jobId': job_id}
+    with embedding_cache.indexing(user_token, document_id) as indexing:
+        DocumentStore.create_document(get_embedding=indexing.get_embedding, **document)
+        return {'documentId': document_id, **indexing.commit()}
+
 
 @_endpoint_route('/documents/add-document')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _upload_document(request):
-    user_token = request['user'].token
-    title = required_parameter(request, 'title')
+    required_parameter(request, 'title')
     if 'text' in request['args']:
         document_content = request['args']['text']
         document_type = 'text'
+        content_hash = lambda: sha256(document_content.encode('utf-8'))
     elif 'file' in request.files:
         document_file = request.files.get('file')
         document_content = document_file.body.decode()
         document_type = 'file'
+        # The uploaded bytes are the UTF-8 encoding of the content already
+        content_hash = lambda: sha256(document_file.body)
     else:
         raise UserException(ERROR_REQUIRED_PARAMETER % "text' or 'file")
 
-    if 'documentid' in request['args'] and request['args']['documentid'] != '':
-        document_id = request['args']['documentid']
-    else:
-        document_id = sha256(document_content.encode('utf-8')).hexdigest()
+    return _create_document(request, document_content, document_type, content_hash)
 
-    if 'origin' in request['args'] and request['args']['origin'] != '':
-        origin = request['args']['origin']
-    else:
-        origin = ''
 
-    document_type = optional_parameter(request, 'type', document_type)
-    replace = 'replace' in request['args'] and request['args']['replace'].lower() == 'true'
+@app_document_endpoints.route(URL_BASE + '/documents/upload-document', methods=['POST', 'PUT'], stream=True)
+@async_respond_with_json
+@requires_auth
+@invalidates_answer_cache
+async def _upload_document_stream(request):
+    """Same as add-document with the file as the raw request body, hashed and spooled as it arrives."""
+    required_parameter(request, 'title')
+    content_hash = sha256()
+    with SpooledTemporaryFile(max_size=DOCUMENT_UPLOAD_SPOOL_SIZE) as spool:
+        while True:
+            body = await request.stream.get()
+            if body is None:
+                break
+            content_hash.update(body)
+            spool.write(body)
+        spool.seek(0)
+        try:
+            document_content = spool.read().decode('utf-8')
+        except UnicodeDecodeError:
+            raise UserException(ERROR_INVALID_DOCUMENT_ENCODING)
 
-    DocumentStore.create_document(user_id=user_token,
-                                  document_id=document_id,
-                                  title=title,
-                                  text=document_content,
-                                  origin=origin,
-                                  document_type=document_type,
-                                  replace=replace,
-                                  get_embedding=Responder.get_document_embeddings)
+    # Splitting and embedding the document takes a while, keep the event loop free
+    return await asyncio.get_event_loop().run_in_executor(
+        None, partial(_create_document, request, document_content, 'file', lambda: content_hash))
 
-    return {'documentId': document_id}
+
+def _archive_members(name, body, max_size) -> List[Tuple[str, int]]:
+    """Name and size of the files of a zip or tar archive read from its headers, or of the file itself when it is not
+    an archive. Stops after DOCUMENT_IMPORT_MAX_FILES + 1 files or once their sizes add up to more than max_size."""
+    if not name.lower().endswith(_ARCHIVE_EXTENSIONS):
+        return [(name, len(body))]
+    try:
+        if name.lower().endswith('.zip'):
+            # Reading a zip member never returns more than the size in its header
+            with zipfile.ZipFile(BytesIO(body)) as archive:
+                return [(member.filename, member.file_size) for member in archive.infolist()
+                        if not member.filename.endswith('/')][:DOCUMENT_IMPORT_MAX_FILES + 1]
+        # Walking the headers of a compressed tar decompresses it, stop as soon as the import is rejected
+        members = []
+        size = 0
+        with tarfile.open(fileobj=BytesIO(body)) as archive:
+            for member in archive:
+                if member.isfile():
+                    members.append((member.name, member.size))
+                    size += member.size
+                    if len(members) > DOCUMENT_IMPORT_MAX_FILES or size > max_size:
+                        break
+        return members
+    except (zipfile.BadZipFile, tarfile.TarError):
+        raise UserException(ERROR_INVALID_ARCHIVE % name)
+
+
+def _archive_files(name, body) -> List[Tuple[str, bytes]]:
+    """Name and content of the files of a zip or tar archive, or of the file itself when it is not an archive."""
+    if not name.lower().endswith(_ARCHIVE_EXTENSIONS):
+        return [(name, body)]
+    try:
+        if name.lower().endswith('.zip'):
+            with zipfile.ZipFile(BytesIO(body)) as archive:
+                return [(member.filename, archive.read(member)) for member in archive.infolist()
+                        if not member.filename.endswith('/')]
+        with tarfile.open(fileobj=BytesIO(body)) as archive:
+            return [(member.name, archive.extractfile(member).read()) for member in archive.getmembers()
+                    if member.isfile()]
+    except (zipfile.BadZipFile, tarfile.TarError):
+        raise UserException(ERROR_INVALID_ARCHIVE % name)
+
+
+def _upload_files(uploads) -> Tuple[List[Tuple[str, bytes]], int]:
+    """Files of the uploads and their total size, checking the number of files and their total size from the archive
+    headers before extracting anything."""
+    members = []
+    size = 0
+    for name, body in uploads:
+        members.extend(_archive_members(name, body, DOCUMENT_IMPORT_MAX_SIZE - size))
+        if len(members) > DOCUMENT_IMPORT_MAX_FILES:
+            raise UserException(ERROR_TOO_MANY_DOCUMENTS % DOCUMENT_IMPORT_MAX_FILES)
+        size = sum(member_size for _, member_size in members)
+        if size > DOCUMENT_IMPORT_MAX_SIZE:
+            raise UserException(ERROR_IMPORT_TOO_LARGE % DOCUMENT_IMPORT_MAX_SIZE)
+    return [file for name, body in uploads for file in _archive_files(name, body)], size
+
+
+def _import_document(user_token, name, body, replace) -> dict:
+    result = {'title': name}
+    try:
+        document_id = sha256(body).hexdigest()
+        with embedding_cache.indexing(user_token, document_id) as indexing:
+            DocumentStore.create_document(user_id=user_token,
+                                          document_id=document_id,
+                                          title=name,
+                                          text=body.decode('utf-8'),
+                                          origin=name,
+                                          document_type='file',
+                                          replace=replace,
+                                          get_embedding=indexing.get_embedding)
+            counts = indexing.commit()
+    except UnicodeDecodeError:
+        return {'success': False, 'error': ERROR_INVALID_DOCUMENT_ENCODING, **result}
+    except Exception as e:
+        return {'success': False, 'error': str(e), **result}
+    return {'success': True, 'documentId': document_id, **counts, **result}
+
+
+def _start_imports(user_token, files, replace) -> list:
+    """Same as _import_document for each file, as document jobs run by the import threads."""
+    results = []
+    for name, body in files:
+        result = {'title': name}
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            results.append({'success': False, 'error': ERROR_INVALID_DOCUMENT_ENCODING, **result})
+            continue
+        document_id = sha256(body).hexdigest()
+        job_id = document_jobs.run_in(_import_executor, user_token,
+                                      {'user_id': user_token, 'document_id': document_id, 'title': name, 'text': text,
+                                       'origin': name, 'document_type': 'file', 'replace': replace})
+        results.append({'success': True, 'documentId': document_id, 'jobId': job_id, **result})
+    return results
+
+
+@_endpoint_route('/documents/add-documents')
+@async_respond_with_json
+@requires_auth
+@invalidates_answer_cache
+async def _import_documents(request):
+    """Create a document from each file uploaded, or from each file of the zip and tar archives uploaded.
+
+    Imports requested in the background, or larger than DOCUMENT_IMPORT_BACKGROUND_SIZE, return once their files are
+    extracted and their items give document job ids instead of the chunk counts."""
+    user_token = request['user'].token
+    replace = optional_parameter(request, 'replace', 'false').lower() == 'true'
+    background = optional_parameter(request, 'background', 'false').lower() == 'true'
+    uploads = [(document_file.name, document_file.body) for document_file in request.files.getlist('file', [])]
+    if not uploads:
+        raise UserException(ERROR_REQUIRED_PARAMETER % 'file')
+
+    loop = asyncio.get_event_loop()
+    files, size = await loop.run_in_executor(_import_executor, _upload_files, uploads)
+    if not files:
+        raise UserException(ERROR_REQUIRED_PARAMETER % 'file')
+    if background or size > DOCUMENT_IMPORT_BACKGROUND_SIZE:
+        results = await loop.run_in_executor(None, _start_imports, user_token, files, replace)
+    else:
+        results = await asyncio.gather(*[loop.run_in_executor(_import_executor, _import_document, user_token, name,
+                                                               body, replace) for name, body in files])
+    return {'totalItems': len(results), 'imported': sum(1 for result in results if result['success']),
+            'items': results}
 
 
 @_endpoint_route('/documents/get-documents')
@@ -79,16 +266,32 @@ def _get_documents(request, number_of_items=30, offset=0, document_ids=None):
     user_token = request['user'].token
     search_term = optional_parameter(request, 'searchTerm', None)
     documents = DocumentStore.get_documents(user_token, document_ids=document_ids, search_term=search_term)
+    pending = document_jobs.pending_documents(user_token)
+    if pending:
+        documents = [document for document in documents if document['id'] not in pending]
     return {'totalItems': len(documents), 'items': documents[offset:offset + number_of_items]}
 
 
+@_endpoint_route('/documents/get-document-job')
+@respond_with_json
+@requires_auth
+def _get_document_job(request):
+    job_id = required_parameter(request, 'jobId')
+    job = document_jobs.status(job_id, request['user'].token)
+    if job is None:
+        raise UserException(ERROR_DOCUMENT_JOB_DOES_NOT_EXIST % job_id)
+    return job
+
+
 @_endpoint_route('/documents/delete-document')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_document(request):
     user_token = request['user'].token
     document_id = required_parameter(request, 'documentId')
     DocumentStore.delete_document(user_token, document_id)
+    embedding_cache.delete_document(user_token, document_id)
     return {'documentId': document_id}
 
 
@@ -0,0 +1,157 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from concurrent.futures import Executor
+from queue import Queue, Full
+from secrets import token_urlsafe
+from tempfile import SpooledTemporaryFile
+from threading import Lock, Thread
+from logging import warning
+from typing import Optional
+
+import numpy as np
+from cape_document_manager.document_store import DocumentStore
+from cape_webservices.app.app_embedding_cache import embedding_cache
+from cape_webservices.app.app_answer_cache import answer_cache
+from cape_webservices.app.app_content_totals import content_totals
+from cape_webservices.webservices_settings import DOCUMENT_JOB_WORKERS, DOCUMENT_JOB_QUEUE_SIZE, \
+    DOCUMENT_JOB_HISTORY, DOCUMENT_JOB_SPOOL_SIZE
+
+# Chunks sent to the responder at a time so the job status shows the progress of large documents
+_EMBEDDING_BATCH_SIZE = 64
+
+
+class DocumentJobs:
+    """Documents split and embedded by background threads from a bounded queue, with the status of recent jobs."""
+
+    def __init__(self, workers: int, queue_size: int, history: int, spool_size: int):
+        self.workers = workers
+        self.history = history
+        self.spool_size = spool_size
+        self._queue = Queue(maxsize=queue_size)
+        # job id -> (user token, status), oldest first
+        self._jobs = OrderedDict()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, user_token: str, document: dict) -> Optional[str]:
+        """Queue the creation of a document from the DocumentStore.create_document arguments, returning the job id or
+        None when the queue is full. The text waits in a temporary file when it is large."""
+        with self._lock:
+            self._start()
+        job_id = self._track(user_token, document)
+        spool = SpooledTemporaryFile(max_size=self.spool_size)
+        spool.write(document['text'].encode('utf-8'))
+        document = {key: value for key, value in document.items() if key != 'text'}
+        try:
+            self._queue.put_nowait((job_id, user_token, document, spool))
+        except Full:
+            spool.close()
+            with self._lock:
+                del self._jobs[job_id]
+            return None
+        return job_id
+
+    def run_in(self, executor: Executor, user_token: str, document: dict) -> str:
+        """Same as submit with the document created by the executor's threads rather than the bounded queue."""
+        job_id = self._track(user_token, document)
+        executor.submit(self._process, job_id, user_token, document)
+        return job_id
+
+    def status(self, job_id: str, user_token: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job[0] != user_token:
+                return None
+            return dict(job[1])
+
+    def pending_documents(self, user_token: str) -> set:
+        """Ids of the documents of a user still queued or processing."""
+        with self._lock:
+            return {job['documentId'] for token, job in self._jobs.values()
+                    if token == user_token and job['status'] in ('queued', 'processing')}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'queued': self._queue.qsize(), 'jobs': len(self._jobs)}
+
+    def _start(self):
+        # Started lazily so that each forked worker gets its own threads
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = Thread(target=self._run, name='document-jobs', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _track(self, user_token, document) -> str:
+        job_id = token_urlsafe(16)
+        with self._lock:
+            # The total number of chunks is known once the document is split
+            self._jobs[job_id] = (user_token, {'jobId': job_id, 'documentId': document['document_id'],
+                                               'status': 'queued', 'chunksTotal': None, 'chunksEmbedded': 0,
+                                               'chunksReused': 0, 'error': None})
+            self._forget()
+        return job_id
+
+    def _forget(self):
+        """Drop the oldest finished jobs beyond the history size."""
+        finished = [job_id for job_id, (_, job) in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    def _update(self, job_id, **values):
+        with self._lock:
+            self._jobs[job_id][1].update(values)
+
+    def _run(self):
+        while True:
+            job_id, user_token, document, spool = self._queue.get()
+            with spool:
+                spool.seek(0)
+                text = spool.read().decode('utf-8')
+            self._process(job_id, user_token, dict(document, text=text))
+
+    def _process(self, job_id, user_token, document):
+        self._update(job_id, status='processing')
+        try:
+            with embedding_cache.indexing(user_token, document['document_id']) as indexing:
+
+                def get_embedding(chunks, *args, **kwargs):
+                    with self._lock:
+                        status = self._jobs[job_id][1]
+                        status['chunksTotal'] = (status['chunksTotal'] or 0) + len(chunks)
+                    batches = []
+                    for start in range(0, len(chunks), _EMBEDDING_BATCH_SIZE):
+                        batches.append(indexing.get_embedding(chunks[start:start + _EMBEDDING_BATCH_SIZE], *args,
+                                                              **kwargs))
+                        self._update(job_id, **indexing.counts())
+                    if len(batches) == 1:
+                        return batches[0]
+                    if all(isinstance(batch, np.ndarray) for batch in batches):
+                        return np.concatenate(batches)
+                    return [embedding for batch in batches for embedding in batch]
+
+                DocumentStore.create_document(get_embedding=get_embedding, **document)
+                self._update(job_id, status='done', **indexing.commit())
+        except Exception as e:
+            warning("Document job %s failed", job_id, exc_info=True)
+            self._update(job_id, status='failed', error=str(e))
+        finally:
+            answer_cache.invalidate(user_token)
+            content_totals.invalidate(user_token)
+
+
+document_jobs = DocumentJobs(DOCUMENT_JOB_WORKERS, DOCUMENT_JOB_QUEUE_SIZE, DOCUMENT_JOB_HISTORY,
+                             DOCUMENT_JOB_SPOOL_SIZE)
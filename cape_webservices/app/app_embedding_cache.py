@@ -0,0 +1,258 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from collections import Counter
+from hashlib import sha256
+from threading import Lock
+from typing import List, Tuple
+
+import numpy as np
+import pkg_resources
+from peewee import SqliteDatabase, Model, CharField, BlobField
+
+from cape_responder.responder_core import Responder
+from cape_webservices.webservices_settings import EMBEDDING_CACHE_SQLITE_PATH, EMBEDDING_CACHE_SHARED, \
+    EMBEDDING_CACHE_MODEL
+
+# SQLite limits the number of variables in a query
+_LOOKUP_BATCH_SIZE = 500
+# Seconds a connection waits for another one to release the database before failing
+_BUSY_TIMEOUT = 30
+
+_embeddings_db = SqliteDatabase(EMBEDDING_CACHE_SQLITE_PATH or ':memory:', timeout=_BUSY_TIMEOUT,
+                                pragmas=(('journal_mode', 'wal'), ('busy_timeout', _BUSY_TIMEOUT * 1000)))
+
+
+class ChunkEmbedding(Model):
+    """Embedding of a document chunk, keyed by the hash of its text and of the user it belongs to unless shared."""
+    namespace = CharField(index=True)
+    chunk_hash = CharField(unique=True)
+    dtype = CharField()
+    shape = CharField()
+    embedding = BlobField()
+
+    class Meta:
+        database = _embeddings_db
+
+
+class DocumentChunk(Model):
+    """Chunks of each document as last indexed, so replacing a document only leaves its changed chunks behind."""
+    user_token = CharField()
+    document_id = CharField()
+    chunk_hash = CharField(index=True)
+
+    class Meta:
+        database = _embeddings_db
+        indexes = ((('user_token', 'document_id'), False),)
+
+
+def _responder_model() -> str:
+    """The model the responder embeds chunks with, the installed cape_responder version unless configured."""
+    if EMBEDDING_CACHE_MODEL:
+        return EMBEDDING_CACHE_MODEL
+    try:
+        return pkg_resources.get_distribution('cape_responder').version
+    except pkg_resources.DistributionNotFound:
+        return ''
+
+
+class DocumentIndexing:
+    """Embeddings of the chunks of one document being created, from the cache or from the responder.
+
+    Used as a context manager: pass get_embedding to DocumentStore.create_document then call commit once the document
+    is stored, the embeddings added for a document that fails to be created are removed on exit."""
+
+    def __init__(self, cache: 'EmbeddingCache', user_token: str, document_id: str):
+        self.cache = cache
+        self.user_token = user_token
+        self.document_id = document_id
+        self._hashes = []
+        self._added = []
+        # Chunks kept in the cache until this document is committed or given up
+        self._held = set()
+        self._committed = False
+        self.reused = 0
+        self.embedded = 0
+
+    def __enter__(self) -> 'DocumentIndexing':
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.cache.enabled:
+            self.cache._release(self._held)
+            if not self._committed and self._added:
+                self.cache._remove_unreferenced(self._added)
+
+    def get_embedding(self, chunks: List[str], *args, **kwargs):
+        if not self.cache.enabled:
+            self.embedded += len(chunks)
+            return Responder.get_document_embeddings(chunks, *args, **kwargs)
+        hashes = self.cache._chunk_hashes(self.user_token, chunks)
+        held = set(hashes) - self._held
+        self.cache._hold(held)
+        self._held |= held
+        embeddings, added, reused = self.cache._get_embeddings(self.user_token, chunks, hashes, *args, **kwargs)
+        self._hashes.extend(hashes)
+        self._added.extend(added)
+        self.reused += reused
+        self.embedded += len(chunks) - reused
+        return embeddings
+
+    def counts(self) -> dict:
+        return {'chunksReused': self.reused, 'chunksEmbedded': self.embedded}
+
+    def commit(self) -> dict:
+        """Record the document's new chunks, dropping the embeddings of the chunks it no longer has."""
+        if self.cache.enabled:
+            self.cache._replace_chunks(self.user_token, self.document_id, self._hashes)
+        self._committed = True
+        return self.counts()
+
+
+class EmbeddingCache:
+    """Wraps Responder.get_document_embeddings so chunks already embedded are never sent to the responder again.
+
+    Chunks are keyed by the responder model as well, so a new model never reuses the embeddings of the previous one."""
+
+    def __init__(self, enabled: bool, shared: bool, model: str):
+        self.enabled = enabled
+        self.shared = shared
+        self.model = model
+        self._lock = Lock()
+        # Writes from the request and job threads take turns rather than waiting on each other inside SQLite
+        self._write_lock = Lock()
+        # Whether the responder returns the embeddings as one array, so cached ones are returned the same way
+        self._stacked = True
+        # Number of documents being indexed by this process that use each chunk, their embeddings are never removed
+        self._holds = Counter()
+        self.hits = 0
+        self.misses = 0
+        if enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(EMBEDDING_CACHE_SQLITE_PATH)), exist_ok=True)
+            _embeddings_db.create_tables([ChunkEmbedding, DocumentChunk], safe=True)
+
+    def indexing(self, user_token: str, document_id: str) -> DocumentIndexing:
+        return DocumentIndexing(self, user_token, document_id)
+
+    def delete_document(self, user_token: str, document_id: str):
+        if self.enabled:
+            self._replace_chunks(user_token, document_id, [])
+
+    def delete(self, user_token: str):
+        """Forget the embeddings of a user's chunks, shared embeddings are kept while other users' documents have
+        them."""
+        if self.enabled:
+            user_chunks = DocumentChunk.user_token == user_token
+            with self._write_lock, _embeddings_db.atomic():
+                hashes = list({chunk.chunk_hash for chunk in DocumentChunk.select(DocumentChunk.chunk_hash)
+                               .where(user_chunks)})
+                DocumentChunk.delete().where(user_chunks).execute()
+                ChunkEmbedding.delete().where(ChunkEmbedding.namespace == user_token).execute()
+            self._remove_unreferenced(hashes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'enabled': self.enabled, 'shared': self.shared, 'hits': self.hits, 'misses': self.misses}
+
+    def _chunk_hashes(self, user_token, chunks) -> List[str]:
+        namespace = '' if self.shared else user_token
+        return [sha256('\0'.join([self.model, namespace, chunk]).encode('utf-8')).hexdigest() for chunk in chunks]
+
+    def _hold(self, hashes):
+        with self._lock:
+            self._holds.update(hashes)
+
+    def _release(self, hashes):
+        with self._lock:
+            self._holds.subtract(hashes)
+            for chunk_hash in hashes:
+                if self._holds[chunk_hash] <= 0:
+                    del self._holds[chunk_hash]
+
+    def _get_embeddings(self, user_token, chunks, hashes, *args, **kwargs) -> Tuple[object, List[str], int]:
+        """Return the embeddings of the chunks, the hashes of those added to the cache and how many the user already
+        had.
+
+        Shared embeddings first added by another user count as embedded, so that users can't tell which texts the
+        others have."""
+        namespace = '' if self.shared else user_token
+        cached = {}
+        for start in range(0, len(hashes), _LOOKUP_BATCH_SIZE):
+            for row in ChunkEmbedding.select().where(
+                    ChunkEmbedding.chunk_hash.in_(hashes[start:start + _LOOKUP_BATCH_SIZE])):
+                cached[row.chunk_hash] = np.frombuffer(row.embedding, dtype=row.dtype) \
+                    .reshape([int(size) for size in row.shape.split(',') if size])
+        missing = [idx for idx, chunk_hash in enumerate(hashes) if chunk_hash not in cached]
+        reused = len(hashes) - len(missing)
+        if self.shared and cached:
+            own = set()
+            hits = list(cached)
+            for start in range(0, len(hits), _LOOKUP_BATCH_SIZE):
+                own.update(chunk.chunk_hash for chunk in DocumentChunk.select(DocumentChunk.chunk_hash).where(
+                    DocumentChunk.user_token == user_token,
+                    DocumentChunk.chunk_hash.in_(hits[start:start + _LOOKUP_BATCH_SIZE])))
+            reused = sum(1 for chunk_hash in hashes if chunk_hash in own)
+        with self._lock:
+            self.hits += len(hashes) - len(missing)
+            self.misses += len(missing)
+        added = [hashes[idx] for idx in missing]
+        if missing:
+            computed = Responder.get_document_embeddings([chunks[idx] for idx in missing], *args, **kwargs)
+            self._stacked = isinstance(computed, np.ndarray)
+            rows = []
+            for idx, embedding in zip(missing, computed):
+                embedding = np.asarray(embedding)
+                cached[hashes[idx]] = embedding
+                rows.append({'namespace': namespace, 'chunk_hash': hashes[idx], 'dtype': embedding.dtype.str,
+                             'shape': ','.join(str(size) for size in embedding.shape),
+                             'embedding': embedding.tobytes()})
+            with self._write_lock, _embeddings_db.atomic():
+                for start in range(0, len(rows), _LOOKUP_BATCH_SIZE // 4):
+                    ChunkEmbedding.insert_many(rows[start:start + _LOOKUP_BATCH_SIZE // 4]) \
+                        .on_conflict_ignore().execute()
+            if len(missing) == len(hashes):
+                return computed, added, reused
+        # Same type as the responder's: one array of all the embeddings, otherwise a list of arrays
+        embeddings = [cached[chunk_hash] for chunk_hash in hashes]
+        if self._stacked and len({embedding.shape for embedding in embeddings}) == 1:
+            return np.stack(embeddings), added, reused
+        return [np.array(embedding) for embedding in embeddings], added, reused
+
+    def _remove_unreferenced(self, hashes):
+        """Delete the embeddings of the chunks that belong to no document and that no document being indexed uses."""
+        with self._write_lock, _embeddings_db.atomic():
+            with self._lock:
+                hashes = [chunk_hash for chunk_hash in hashes if chunk_hash not in self._holds]
+            for start in range(0, len(hashes), _LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + _LOOKUP_BATCH_SIZE]
+                # Chunks may also belong to other documents, or to documents of other users when shared
+                referenced = DocumentChunk.select(DocumentChunk.chunk_hash).where(DocumentChunk.chunk_hash.in_(batch))
+                ChunkEmbedding.delete().where(ChunkEmbedding.chunk_hash.in_(batch),
+                                              ChunkEmbedding.chunk_hash.not_in(referenced)).execute()
+
+    def _replace_chunks(self, user_token, document_id, hashes):
+        with self._write_lock, _embeddings_db.atomic():
+            document_chunks = (DocumentChunk.user_token == user_token) & (DocumentChunk.document_id == document_id)
+            previous = {chunk.chunk_hash for chunk in DocumentChunk.select(DocumentChunk.chunk_hash)
+                        .where(document_chunks)}
+            DocumentChunk.delete().where(document_chunks).execute()
+            rows = [{'user_token': user_token, 'document_id': document_id, 'chunk_hash': chunk_hash}
+                    for chunk_hash in set(hashes)]
+            for start in range(0, len(rows), _LOOKUP_BATCH_SIZE // 3):
+                DocumentChunk.insert_many(rows[start:start + _LOOKUP_BATCH_SIZE // 3]).execute()
+        self._remove_unreferenced(list(previous - set(hashes)))
+
+
+embedding_cache = EmbeddingCache(bool(EMBEDDING_CACHE_SQLITE_PATH), EMBEDDING_CACHE_SHARED, _responder_model())
@@ -12,11 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import re
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from typing import Optional
+
+from peewee import fn
+
 from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_inbox_endpoints
 
-from cape_webservices.app.app_middleware import respond_with_json, requires_auth
+from cape_webservices.app.app_middleware import respond_with_json, async_respond_with_json, requires_auth, \
+    time_parameter
+from cape_userdb.base import DB
 from cape_userdb.event import Event
+from cape_webservices.events.events_feed import inbox_feed
+from cape_webservices.webservices_settings import INBOX_WAIT_MAX_TIMEOUT, INBOX_WAIT_POLL_INTERVAL
+from cape_webservices.events.events_models import EventSearch, EVENT_SEARCH_ENABLED, InboxCounter
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.output import list_response
 from cape_api_helpers.input import required_parameter, optional_parameter
@@ -24,6 +38,116 @@ from cape_api_helpers.text_responses import *
 
 _endpoint_route = lambda x: app_inbox_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
+_CURSOR_TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+ERROR_INVALID_INBOX_CURSOR = "Invalid inbox cursor '%s'"
+ERROR_INVALID_INBOX_IDS = "Invalid inboxIds, it must be a JSON list of inbox ids"
+ERROR_INVALID_SINCE = "Invalid since '%s', it must be the since value of a previous response"
+ERROR_INVALID_TIMEOUT = "Invalid timeout '%s', it must be a number of seconds between 0 and %d"
+ERROR_INVALID_NUMBER_OF_ITEMS = "Invalid numberOfItems '%s', it must be a positive integer"
+
+
+def _encode_inbox_cursor(position) -> str:
+    return urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def _decode_inbox_cursor(cursor):
+    """Return the created time and id of the last event of the previous page, or the offset of the next page of
+    search results which are ordered by relevance."""
+    try:
+        position = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if isinstance(position, int):
+            return position
+        created, event_id = position
+        for time_format in _CURSOR_TIME_FORMATS:
+            try:
+                return datetime.strptime(created, time_format), int(event_id)
+            except ValueError:
+                pass
+    except (ValueError, TypeError):
+        pass
+    raise UserException(ERROR_INVALID_INBOX_CURSOR % cursor)
+
+
+def _inbox_item(event) -> dict:
+    return {
+        'id': str(event.id),
+        'question': event.question,
+        'read': event.read,
+        'answered': event.answered,
+        'answers': event.answers,
+        'created': event.created,
+        'modified': event.modified,
+        'questionSource': event.question_source
+    }
+
+
+def _filter_inbox(query, request):
+    """Apply the read and answered filters of the request to an Event query."""
+    read = optional_parameter(request, 'read', 'both').lower()
+    answered = optional_parameter(request, 'answered', 'both').lower()
+    if read == 'true':
+        query = query.where(Event.read == True)
+    elif read == 'false':
+        query = query.where(Event.read == False)
+    if answered == 'true':
+        query = query.where(Event.answered == True)
+    elif answered == 'false':
+        query = query.where(Event.answered == False)
+    return query
+
+
+def _update_inbox(request, **values) -> int:
+    """Update the inbox events given by inboxIds, or else matching the read, answered, before and after filters,
+    in a single statement scoped to the logged in user. Events already set to the values are left untouched, so the
+    count returned is the number of events changed."""
+    user_id = request['user'].user_id
+    query = Event.update(modified=datetime.now(), **values).where(Event.user_id == user_id, Event.archived == False,
+                                                                  *[getattr(Event, field) != value
+                                                                    for field, value in values.items()])
+    inbox_ids = optional_parameter(request, 'inboxIds', None)
+    if inbox_ids is not None:
+        try:
+            inbox_ids = [int(inbox_id) for inbox_id in json.loads(inbox_ids)]
+        except (ValueError, TypeError):
+            raise UserException(ERROR_INVALID_INBOX_IDS)
+        query = query.where(Event.id.in_(inbox_ids))
+    query = _filter_inbox(query, request)
+    before = time_parameter(request, 'before')
+    if before is not None:
+        query = query.where(Event.created < before)
+    after = time_parameter(request, 'after')
+    if after is not None:
+        query = query.where(Event.created >= after)
+    return query.execute()
+
+
+def _inbox_counts(user_id) -> dict:
+    counter = InboxCounter.get_or_none(InboxCounter.user_id == user_id)
+    if counter is None:
+        return {'total': 0, 'unread': 0, 'unanswered': 0, 'archived': 0}
+    return {'total': counter.total, 'unread': counter.unread, 'unanswered': counter.unanswered,
+            'archived': counter.archived}
+
+
+def _counted_total(user_id, read, answered) -> Optional[int]:
+    """Number of inbox events matching the read and answered filters from the counters, None when not counted."""
+    counts = _inbox_counts(user_id)
+    inbox = counts['total'] - counts['archived']
+    if answered == 'both':
+        return {'both': inbox, 'false': counts['unread'], 'true': inbox - counts['unread']}.get(read)
+    if read == 'both':
+        return {'false': counts['unanswered'], 'true': inbox - counts['unanswered']}.get(answered)
+    return None
+
+
+def _search_query(search_term) -> str:
+    """FTS5 query matching events containing all the words of the search term, the last one as a prefix."""
+    words = ['"%s"' % word for word in re.findall(r'\w+', search_term)]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
 
 @_endpoint_route('/inbox/get-inbox')
 @requires_auth
@@ -31,37 +155,52 @@ _endpoint_route = lambda x: app_inbox_endpoints.route(URL_BASE + x, methods=['GE
 @respond_with_json
 def _get_inbox(request, number_of_items=30, offset=0):
     user_id = request['user'].user_id
-    read = optional_parameter(request, 'read', 'both').lower()
-    answered = optional_parameter(request, 'answered', 'both').lower()
     search_term = optional_parameter(request, 'searchTerm', None)
+    cursor = optional_parameter(request, 'cursor', None)
+    with_total = optional_parameter(request, 'withTotal', 'true').lower() == 'true'
 
-    events_query = Event.select().where(Event.user_id == user_id, Event.archived == False)
-    if read == 'true':
-        events_query = events_query.where(Event.read == True)
-    elif read == 'false':
-        events_query = events_query.where(Event.read == False)
-    if answered == 'true':
-        events_query = events_query.where(Event.answered == True)
-    elif answered == 'false':
-        events_query = events_query.where(Event.answered == False)
-    if search_term is not None:
+    events_query = _filter_inbox(Event.select().where(Event.user_id == user_id, Event.archived == False), request)
+    order_by = [Event.created.desc(), Event.id.desc()]
+    by_relevance = search_term is not None and EVENT_SEARCH_ENABLED and _search_query(search_term) != ''
+    if by_relevance:
+        events_query = events_query.join(EventSearch, on=(EventSearch.rowid == Event.id)) \
+            .where(EventSearch.match(_search_query(search_term)))
+        order_by.insert(0, EventSearch.rank())
+    elif search_term is not None:
         events_query = events_query.where(Event.question.contains(search_term))
 
     events = []
-    total_items = events_query.count()
-    for event in events_query.limit(number_of_items).order_by(Event.created.desc()).offset(offset):
-        events.append({
-            'id': str(event.id),
-            'question': event.question,
-            'read': event.read,
-            'answered': event.answered,
-            'answers': event.answers,
-            'created': event.created,
-            'modified': event.modified,
-            'questionSource': event.question_source
-        })
-
-    return {"totalItems": total_items, "items": events}
+    total_items = None
+    if with_total:
+        if search_term is None:
+            total_items = _counted_total(user_id, optional_parameter(request, 'read', 'both').lower(),
+                                         optional_parameter(request, 'answered', 'both').lower())
+        if total_items is None:
+            total_items = events_query.count()
+    if cursor is not None:
+        position = _decode_inbox_cursor(cursor)
+        if isinstance(position, int):
+            offset = position
+        else:
+            # Keyset pagination, the cost of a page does not grow with its depth and new events do not shift pages
+            created, event_id = position
+            events_query = events_query.where((Event.created < created) |
+                                              ((Event.created == created) & (Event.id < event_id)))
+            offset = 0
+    page = list(events_query.order_by(*order_by).limit(number_of_items).offset(offset))
+    for event in page:
+        events.append(_inbox_item(event))
+
+    next_cursor = None
+    if len(page) == number_of_items:
+        if by_relevance:
+            next_cursor = _encode_inbox_cursor(offset + number_of_items)
+        else:
+            next_cursor = _encode_inbox_cursor([page[-1].created.isoformat(), page[-1].id])
+    response = {"items": events, "nextCursor": next_cursor}
+    if with_total:
+        response["totalItems"] = total_items
+    return response
 
 
 @_endpoint_route('/inbox/mark-inbox-read')
@@ -94,3 +233,64 @@ def _archive_inbox(request):
     event.save()
 
     return {'inboxId': inbox_id}
+
+
+@_endpoint_route('/inbox/bulk-mark-inbox-read')
+@requires_auth
+@respond_with_json
+def _bulk_mark_inbox_read(request):
+    return {'updated': _update_inbox(request, read=True)}
+
+
+@_endpoint_route('/inbox/bulk-archive-inbox')
+@requires_auth
+@respond_with_json
+def _bulk_archive_inbox(request):
+    return {'updated': _update_inbox(request, archived=True)}
+
+
+@_endpoint_route('/inbox/get-inbox-counts')
+@requires_auth
+@respond_with_json
+def _get_inbox_counts(request):
+    return _inbox_counts(request['user'].user_id)
+
+
+@_endpoint_route('/inbox/wait-inbox')
+@async_respond_with_json
+@requires_auth
+async def _wait_inbox(request):
+    """Long polling for new inbox events, returns as soon as there are events after since or when the timeout expires.
+    Without since, only events arriving from now on are returned."""
+    user_id = request['user'].user_id
+    since = optional_parameter(request, 'since', None)
+    timeout = optional_parameter(request, 'timeout', str(INBOX_WAIT_MAX_TIMEOUT))
+    number_of_items = optional_parameter(request, 'numberOfItems', '30')
+    if since is not None and not since.isnumeric():
+        raise UserException(ERROR_INVALID_SINCE % since)
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise UserException(ERROR_INVALID_TIMEOUT % (timeout, INBOX_WAIT_MAX_TIMEOUT))
+    if not 0 <= timeout <= INBOX_WAIT_MAX_TIMEOUT:
+        raise UserException(ERROR_INVALID_TIMEOUT % (timeout, INBOX_WAIT_MAX_TIMEOUT))
+    if not number_of_items.isnumeric() or int(number_of_items) == 0:
+        raise UserException(ERROR_INVALID_NUMBER_OF_ITEMS % number_of_items)
+
+    if since is None:
+        if DB.is_closed():
+            DB.connect()
+        since = Event.select(fn.MAX(Event.id)).where(Event.user_id == user_id).scalar() or 0
+    deadline = time.time() + timeout
+    while True:
+        # Other requests close the connection while this one waits
+        if DB.is_closed():
+            DB.connect()
+        events = list(Event.select().where(Event.user_id == user_id, Event.id > int(since), Event.archived == False)
+                      .order_by(Event.id).limit(int(number_of_items)))
+        remaining = deadline - time.time()
+        if events or remaining <= 0:
+            break
+        await inbox_feed.wait(user_id, min(remaining, INBOX_WAIT_POLL_INTERVAL))
+
+    return {'items': [_inbox_item(event) for event in events], 'since': str(events[-1].id if events else since)}
@@ -0,0 +1,162 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock, Event
+from logging import info, warning
+
+from cape_document_manager.document_store import DocumentStore
+from cape_webservices.app.app_embedding_cache import embedding_cache
+from cape_webservices.webservices_settings import INLINE_TEXT_CACHE_MAX_CHARS, INLINE_TEXT_CACHE_TTL
+
+# Document store namespace holding the processed inline texts, shared by all users since ids are content hashes
+INLINE_TEXT_USER = '__inline_text__'
+
+
+class InlineTextCache:
+    """Processed inline texts stored as documents keyed by their sha256, with TTL and size bounded eviction."""
+
+    def __init__(self, max_chars: int, ttl: int):
+        self.max_chars = max_chars
+        self.ttl = ttl
+        # document id -> [expiry time, number of characters], least recently used first
+        self._entries = OrderedDict()
+        self._chars = 0
+        # document id -> event set once the document is created or deleted
+        self._creating = {}
+        # document id -> number of requests reading the document
+        self._in_use = {}
+        self._purged = False
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_chars > 0
+
+    @contextmanager
+    def document(self, text: str):
+        """Yield the id of the processed document for the text, splitting and embedding it on first use.
+
+        The document is not evicted before the block exits."""
+        document_id = self._acquire(text)
+        try:
+            yield document_id
+        finally:
+            with self._lock:
+                self._in_use[document_id] -= 1
+                if not self._in_use[document_id]:
+                    del self._in_use[document_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'chars': self._chars, 'maxChars': self.max_chars, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'inUse': len(self._in_use)}
+
+    def _acquire(self, text: str) -> str:
+        document_id = sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            purge = not self._purged
+            self._purged = True
+        if purge:
+            self._purge()
+        while True:
+            with self._lock:
+                entry = self._entries.get(document_id)
+                if entry is not None and entry[0] > time.time():
+                    entry[0] = time.time() + self.ttl
+                    self._entries.move_to_end(document_id)
+                    self._in_use[document_id] = self._in_use.get(document_id, 0) + 1
+                    self.hits += 1
+                    return document_id
+                creating = self._creating.get(document_id)
+                if creating is None:
+                    self._creating[document_id] = Event()
+                    break
+            # Another request is processing or deleting the same text
+            creating.wait()
+        evicted = []
+        try:
+            with embedding_cache.indexing(INLINE_TEXT_USER, document_id) as indexing:
+                DocumentStore.create_document(user_id=INLINE_TEXT_USER, document_id=document_id, title=document_id,
+                                              text=text, origin='', document_type='text', replace=True,
+                                              get_embedding=indexing.get_embedding)
+                indexing.commit()
+            with self._lock:
+                self.misses += 1
+                if document_id in self._entries:
+                    self._chars -= self._entries[document_id][1]
+                self._entries[document_id] = [time.time() + self.ttl, len(text)]
+                self._entries.move_to_end(document_id)
+                self._chars += len(text)
+                self._in_use[document_id] = self._in_use.get(document_id, 0) + 1
+                evicted = self._evict()
+        finally:
+            with self._lock:
+                self._creating.pop(document_id).set()
+        self._delete(evicted)
+        return document_id
+
+    def _evict(self) -> list:
+        """Drop expired entries then the least recently used ones until the cache fits, returning their ids.
+
+        Entries in use are kept, the evicted ones are marked as being processed until _delete is done with them."""
+        now = time.time()
+        chars = self._chars
+        evicted = []
+        for document_id, (expiry, size) in self._entries.items():
+            if document_id not in self._in_use and document_id not in self._creating and \
+                    (expiry <= now or chars > self.max_chars):
+                evicted.append(document_id)
+                chars -= size
+        for document_id in evicted:
+            self._chars -= self._entries.pop(document_id)[1]
+            self._creating[document_id] = Event()
+        self.evictions += len(evicted)
+        return evicted
+
+    def _delete(self, document_ids):
+        """Delete documents outside of the lock, requests for the same texts wait until they are gone."""
+        for document_id in document_ids:
+            try:
+                DocumentStore.delete_document(INLINE_TEXT_USER, document_id)
+                embedding_cache.delete_document(INLINE_TEXT_USER, document_id)
+            except Exception:
+                warning("Could not delete cached inline text %s", document_id, exc_info=True)
+            finally:
+                with self._lock:
+                    self._creating.pop(document_id).set()
+
+    def _purge(self):
+        """Delete the documents left over by a previous process, their expiry is unknown."""
+        try:
+            documents = DocumentStore.get_documents(INLINE_TEXT_USER)
+        except Exception:
+            warning("Could not purge cached inline texts", exc_info=True)
+            return
+        with self._lock:
+            stale = [document['id'] for document in documents
+                     if document['id'] not in self._entries and document['id'] not in self._creating]
+            for document_id in stale:
+                self._creating[document_id] = Event()
+        self._delete(stale)
+        info("Purged %d cached inline texts", len(stale))
+
+
+inline_text_cache = InlineTextCache(INLINE_TEXT_CACHE_MAX_CHARS, INLINE_TEXT_CACHE_TTL)
@@ -0,0 +1,132 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from typing import Optional
+
+from cape_webservices.webservices_settings import ANSWER_MAX_IN_FLIGHT, ANSWER_TARGET_LATENCY, \
+    SPEED_OR_ACCURACY_PLAN_FLOORS, ANSWER_EXECUTOR_THREADS
+
+# From the most to the least expensive
+SPEED_OR_ACCURACY_MODES = ['total', 'accuracy', 'balanced', 'speed']
+
+
+class AnswerLoadController:
+    """Steps the speedOrAccuracy mode down while the responder is under pressure."""
+
+    # Weight of the latest responder latency in the moving average
+    _SMOOTHING = 0.2
+
+    def __init__(self, max_in_flight: int, target_latency: float, plan_floors: dict):
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+        self.plan_floors = plan_floors
+        self.in_flight = 0
+        self.latency = 0.0
+        self.degraded = 0
+        self._lock = Lock()
+
+    def pressure(self) -> int:
+        """Number of modes to step down, 0 while the responder keeps up."""
+        with self._lock:
+            load = max(self.in_flight / max(1, self.max_in_flight), self.latency / self.target_latency)
+        if load <= 1:
+            return 0
+        return min(len(SPEED_OR_ACCURACY_MODES) - 1, int(load))
+
+    def choose(self, speed_or_accuracy: str, plan: str) -> str:
+        """Return the mode to use for the requested one, never going below the floor of the user's plan."""
+        requested = SPEED_OR_ACCURACY_MODES.index(speed_or_accuracy)
+        floor = max(requested, SPEED_OR_ACCURACY_MODES.index(self.plan_floors.get(plan, 'speed')))
+        chosen = min(requested + self.pressure(), floor)
+        if chosen != requested:
+            with self._lock:
+                self.degraded += 1
+        return SPEED_OR_ACCURACY_MODES[chosen]
+
+    @contextmanager
+    def track(self):
+        """Count a responder computation as in flight and record its latency."""
+        start_time = time.time()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.latency += self._SMOOTHING * (time.time() - start_time - self.latency)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'inFlight': self.in_flight, 'latency': self.latency, 'degraded': self.degraded}
+
+
+answer_load_controller = AnswerLoadController(ANSWER_MAX_IN_FLIGHT, ANSWER_TARGET_LATENCY,
+                                              SPEED_OR_ACCURACY_PLAN_FLOORS)
+
+
+class ResponderCalls:
+    """Runs the responder calls of the answers on a fixed number of threads so that they can be waited on until a
+    deadline.
+
+    Cancelling only stops calls still waiting for a thread, a running call keeps its thread until the responder
+    returns. Calls abandoned at their deadline are counted, and new calls are refused rather than queued behind them
+    once every thread is taken."""
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._lock = Lock()
+        self.running = 0
+        self.abandoned = 0
+        self.refused = 0
+
+    def submit(self, fn, *args) -> Optional[Future]:
+        """Start a call, or return None when every thread is taken."""
+        with self._lock:
+            if self.running >= self.threads:
+                self.refused += 1
+                return None
+            self.running += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def abandon(self, future: Future):
+        """Give up on a call, it keeps its thread until it returns when it is already running."""
+        if not future.cancel():
+            with self._lock:
+                self.abandoned += 1
+            future.add_done_callback(self._forget)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'threads': self.threads, 'running': self.running, 'abandoned': self.abandoned,
+                    'refused': self.refused}
+
+    def _done(self, future):
+        with self._lock:
+            self.running -= 1
+
+    def _forget(self, future):
+        with self._lock:
+            self.abandoned -= 1
+
+
+# Each answer makes at most two responder calls at once
+responder_calls = ResponderCalls(2 * ANSWER_EXECUTOR_THREADS)
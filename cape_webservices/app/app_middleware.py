@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import json
+from datetime import datetime
 from functools import wraps
 
 from cape_api_helpers.exceptions import UserException
@@ -21,6 +22,13 @@ from logging import debug
 from sanic.response import json as jsonify
 from sanic.response import text as textify
 from cape_webservices.app.app_settings import app_endpoints, URL_BASE
+from cape_webservices.app.app_answer_cache import answer_cache, answer_coalescer
+from cape_webservices.app.app_load_control import answer_load_controller, responder_calls
+from cape_webservices.app.app_inline_text_cache import inline_text_cache
+from cape_webservices.app.app_document_jobs import document_jobs
+from cape_webservices.app.app_embedding_cache import embedding_cache
+from cape_webservices.events.events_writer import event_writer
+from cape_webservices.events.events_feed import inbox_feed
 from cape_userdb.user import User
 from cape_userdb.session import Session
 from cape_userdb.base import DB
@@ -38,6 +46,9 @@ _MUST_BE_GET_PARAM = {'admintoken', 'token'}  # because these are used in routin
 # these as POST parameters
 _MUST_BE_POST_PARAM = {'successcallback', 'errorcallback'}
 _SLACK_TYPES = {'event_callback', 'url_verification'}
+_TIME_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S']
+
+ERROR_INVALID_TIME = "Invalid %s '%s', it must be a date (YYYY-MM-DD) or a time (YYYY-MM-DDTHH:MM:SS)"
 
 
 def status(request):
@@ -47,7 +58,16 @@ def status(request):
             'headers': dict(request.headers),
             'client_ip': request.headers.get('x-client-ip', request.ip),
             'url_params': request['args'],
-            'plugins': webapp_core.enabled_plugins
+            'plugins': webapp_core.enabled_plugins,
+            'answerCache': answer_cache.stats(),
+            'answerCoalescing': answer_coalescer.stats(),
+            'answerLoad': answer_load_controller.stats(),
+            'responderCalls': responder_calls.stats(),
+            'inlineTextCache': inline_text_cache.stats(),
+            'eventWriter': event_writer.stats(),
+            'inboxFeed': inbox_feed.stats(),
+            'documentJobs': document_jobs.stats(),
+            'embeddingCache': embedding_cache.stats()
             }
 
 
@@ -63,6 +83,20 @@ def respond_with_json(decorated):
     return wrapper
 
 
+def async_respond_with_json(decorated):
+    """Same as respond_with_json for coroutine endpoints."""
+
+    @wraps(decorated)
+    async def wrapper(request, *args, **kw):
+        status = 200
+        result = await decorated(request, *args, **kw)
+        if 'success' not in result:
+            result = {'success': True, 'result': result}
+        return jsonify(result, status=status, headers=generate_cors_headers(request))
+
+    return wrapper
+
+
 def respond_with_plain_json(decorated):
     @wraps(decorated)
     def wrapper(request, *args, **kw):
@@ -224,3 +258,16 @@ def requires_admin(wrapped):
             raise UserException(ADMIN_ONLY)
 
     return decorated
+
+
+def time_parameter(request, parameter):
+    """Optional date or time parameter, None when missing."""
+    value = optional_parameter(request, parameter, None)
+    if value is None:
+        return None
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise UserException(ERROR_INVALID_TIME % (parameter, value))
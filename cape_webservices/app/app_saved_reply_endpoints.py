@@ -16,6 +16,7 @@ from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_saved_reply_endpoints
 
 from cape_webservices.app.app_middleware import respond_with_json, requires_auth
+from cape_webservices.app.app_answer_cache import invalidates_answer_cache
 from cape_document_manager.annotation_store import AnnotationStore
 from cape_api_helpers.output import list_response
 from cape_api_helpers.input import required_parameter, optional_parameter, list_saved_reply_ids
@@ -39,6 +40,7 @@ def _get_saved_replies(request, number_of_items=30, offset=0, saved_reply_ids=No
 @_endpoint_route('/saved-replies/add-saved-reply')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _create_saved_reply(request):
     user_token = request['user'].token
     question = required_parameter(request, 'question')
@@ -50,6 +52,7 @@ def _create_saved_reply(request):
 @_endpoint_route('/saved-replies/delete-saved-reply')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_saved_reply(request):
     user_token = request['user'].token
     reply_id = required_parameter(request, 'replyId')
@@ -60,6 +63,7 @@ def _delete_saved_reply(request):
 @_endpoint_route('/saved-replies/edit-canonical-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_canonical_question(request):
     user_token = request['user'].token
     reply_id = required_parameter(request, 'replyId')
@@ -71,6 +75,7 @@ def _edit_canonical_question(request):
 @_endpoint_route('/saved-replies/add-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _add_paraphrase_question(request):
     user_token = request['user'].token
     reply_id = required_parameter(request, 'replyId')
@@ -81,6 +86,7 @@ def _add_paraphrase_question(request):
 @_endpoint_route('/saved-replies/edit-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_paraphrase_question(request):
     user_token = request['user'].token
     question_id = required_parameter(request, 'questionId')
@@ -91,6 +97,7 @@ def _edit_paraphrase_question(request):
 @_endpoint_route('/saved-replies/delete-paraphrase-question')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_paraphrase_question(request):
     user_token = request['user'].token
     question_id = required_parameter(request, 'questionId')
@@ -100,6 +107,7 @@ def _delete_paraphrase_question(request):
 @_endpoint_route('/saved-replies/add-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _add_answer(request):
     user_token = request['user'].token
     reply_id = required_parameter(request, 'replyId')
@@ -110,6 +118,7 @@ def _add_answer(request):
 @_endpoint_route('/saved-replies/edit-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _edit_answer(request):
     user_token = request['user'].token
     answer_id = required_parameter(request, 'answerId')
@@ -120,6 +129,7 @@ def _edit_answer(request):
 @_endpoint_route('/saved-replies/delete-answer')
 @respond_with_json
 @requires_auth
+@invalidates_answer_cache
 def _delete_answer(request):
     user_token = request['user'].token
     answer_id = required_parameter(request, 'answerId')
@@ -17,24 +17,43 @@ from cape_webservices.app.app_settings import URL_BASE
 from cape_webservices.app.app_settings import app_user_endpoints
 from cape_userdb.cape_userdb_settings import DEFAULT_EMAIL
 
-from cape_webservices.app.app_middleware import respond_with_json, requires_auth, requires_admin
+from cape_webservices.app.app_middleware import respond_with_json, requires_auth, requires_admin, time_parameter
 from cape_userdb.user import User
 from cape_userdb.event import Event
 from cape_userdb.session import Session
-from cape_userdb.coverage import Coverage
+from cape_webservices.events.events_models import EventSourceCounter, CoverageRollup
+from cape_webservices.events.events_core import COVERAGE_RESOLUTIONS
+from cape_webservices.webservices_settings import STATS_MAX_COVERAGE_POINTS
 from cape_responder.responder_core import THRESHOLD_MAP
 from cape_webservices.manage_users import create_user, delete_all_user_data
-from cape_document_manager.annotation_store import AnnotationStore
 from cape_document_manager.document_store import DocumentStore
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.input import required_parameter, optional_parameter
+from cape_api_helpers.output import list_response
 from cape_api_helpers.text_responses import *
+from cape_webservices.app.app_content_totals import content_totals
 from peewee import IntegrityError
 
 _endpoint_route = lambda x: app_user_endpoints.route(URL_BASE + x, methods=['GET', 'POST'])
 
 AVAILABLE_PLANS = {'free', 'basic', 'pro'}
 
+ERROR_INVALID_RESOLUTION = "Invalid resolution '%s', it must be one of: %s"
+
+
+def _coverage_points(user_id, resolution, start, end):
+    """Most recent coverage of each period in the time range, oldest first."""
+    if resolution not in COVERAGE_RESOLUTIONS:
+        raise UserException(ERROR_INVALID_RESOLUTION % (resolution, ', '.join(COVERAGE_RESOLUTIONS)))
+    query = CoverageRollup.select(CoverageRollup.coverage, CoverageRollup.period) \
+        .where(CoverageRollup.user_id == user_id, CoverageRollup.resolution == resolution)
+    if start is not None:
+        query = query.where(CoverageRollup.period >= COVERAGE_RESOLUTIONS[resolution](start))
+    if end is not None:
+        query = query.where(CoverageRollup.period < end)
+    stats = query.order_by(CoverageRollup.period.desc()).limit(STATS_MAX_COVERAGE_POINTS)
+    return [{'coverage': stat.coverage, 'time': stat.period} for stat in reversed(list(stats))]
+
 
 @_endpoint_route('/user/login')
 @respond_with_json
@@ -194,29 +213,10 @@ def _delete_user(request):
 
 
 
-@_endpoint_route('/user/stats')
-@respond_with_json
-@requires_auth
-def _stats(request):
-    user_id = request['user'].user_id
-    events = Event.select().where(Event.user_id == user_id).order_by(Event.created.desc())
-    total = events.count()
-    automatic = 0
-    assisted = 0
-    unanswered = 0
-    total_duration = 0
-    average_response_time = 0
+def _stats_questions(user_id, number_of_items, offset):
     questions = []
-    source_count = {}
-    coverage = []
-
-    # Find total number of saved replies
-    total_saved_replies = len(AnnotationStore.get_annotations(request['user'].token, saved_replies=True))
-
-    # Find total number of documents
-    documents = DocumentStore.get_documents(request['user'].token)
-    total_documents = len(documents)
-
+    events = Event.select().where(Event.user_id == user_id).order_by(Event.created.desc()) \
+        .limit(number_of_items).offset(offset)
     for event in events:
         question = {
             'created': event.created.isoformat(),
@@ -225,24 +225,54 @@ def _stats(request):
         }
         if event.answered:
             answer = event.answers[0]
-            total_duration += event.duration
             question['answer'] = answer['answerText']
             if answer['sourceType'] == 'saved_reply':
-                automatic += 1
                 question['status'] = 'automatic'
                 question['matchedQuestion'] = answer['matchedQuestion']
             else:
-                assisted += 1
                 question['status'] = 'assisted'
-                if answer['sourceId'] in source_count:
-                    source_count[answer['sourceId']] += 1
-                else:
-                    source_count[answer['sourceId']] = 1
         else:
-            unanswered += 1
             question['status'] = 'unanswered'
         questions.append(question)
+    return questions
+
 
+@_endpoint_route('/user/stats')
+@requires_auth
+@list_response
+@respond_with_json
+def _stats(request, number_of_items=30, offset=0):
+    user_id = request['user'].user_id
+    resolution = optional_parameter(request, 'resolution', 'day')
+    start = time_parameter(request, 'from')
+    end = time_parameter(request, 'to')
+    coverage = _coverage_points(user_id, resolution, start, end)
+    total = 0
+    automatic = 0
+    assisted = 0
+    unanswered = 0
+    total_duration = 0
+    average_response_time = 0
+    source_count = {}
+
+    total_saved_replies, total_documents = content_totals.get(request['user'].token)
+
+    for counter in EventSourceCounter.select().where(EventSourceCounter.user_id == user_id):
+        total += counter.total
+        if counter.source == 'unanswered':
+            unanswered += counter.total
+            continue
+        total_duration += counter.duration
+        if counter.source == 'saved_reply':
+            automatic += counter.total
+        else:
+            assisted += counter.total
+            source_count[counter.source] = counter.total
+
+    documents = {}
+    if len(source_count) > 0:
+        documents = {document['id']: document for document in
+                     DocumentStore.get_documents(request['user'].token, document_ids=list(source_count))}
     source_count['saved_reply'] = automatic
     source_count['unanswered'] = unanswered
     sources = sorted(source_count.items(), key=lambda x: x[1], reverse=True)
@@ -253,21 +283,24 @@ def _stats(request):
                 document_title = 'Saved replies'
             elif source[0] == 'unanswered':
                 document_title = 'Unanswered'
+            elif source[0] in documents:
+                document_title = documents[source[0]]['title'] or source[0]
             else:
-                document_title = source[0]
-                if source[0] in documents:
-                    if documents:
-                        if len(documents[source[0]]['title']) > 0:
-                            document_title = documents[source[0]]['title']
-                else:
-                    document_title = 'Deleted document'
+                document_title = 'Deleted document'
             sources_percent.append({'source': source[0], 'title': document_title, 'percent': (source[1] / total) * 100})
         average_response_time = total_duration / total
 
-    coverage_stats = Coverage.select().where(Coverage.user_id == user_id)
-    for stat in coverage_stats:
-        coverage.append({'coverage': stat.coverage, 'time': stat.created})
-
     return {'averageResponseTime': average_response_time, 'totalSavedReplies': total_saved_replies,
             'totalDocuments': total_documents, 'totalQuestions': total, 'automatic': automatic, 'assisted': assisted,
-            'unanswered': unanswered, 'sources': sources_percent, 'questions': questions, 'coverage': coverage}
+            'unanswered': unanswered, 'sources': sources_percent,
+            'questions': _stats_questions(user_id, number_of_items, offset), 'coverage': coverage}
+
+
+@_endpoint_route('/user/stats-questions')
+@requires_auth
+@list_response
+@respond_with_json
+def _stats_questions_page(request, number_of_items=30, offset=0):
+    user_id = request['user'].user_id
+    total = Event.select().where(Event.user_id == user_id).count()
+    return {'totalItems': total, 'items': _stats_questions(user_id, number_of_items, offset)}
@@ -45,6 +45,8 @@ NUMERICAL_EXPRESSION_ENDER = re.compile('[%s]' % re.escape(string.digits + ')'))
 _previous_answers = {}
 # Index of the last answer provided from _previous_answers, broken down by bot and channel
 _last_answer = {}
+# Cursor id and offset of the next page of answers to the last question, broken down by bot and channel
+_answer_cursors = {}
 # Echo mode
 _ECHO_MODE = {}
 
@@ -121,9 +123,29 @@ def _explain(user, comm_id, *args):
             "text": f"I thought you asked (Index {previous['confidence']:.2f})\n_{previous['matchedQuestion']}_\n>>>{previous['answerText']}"}
 
 
+def _fetch_more_answers(user, comm_id, request):
+    if comm_id not in _answer_cursors:
+        return
+    cursor_id, offset = _answer_cursors[comm_id]
+    request['args']['token'] = user.token
+    request['args']['cursorid'] = cursor_id
+    request['args']['offset'] = str(offset)
+    request['args']['numberofitems'] = '5'
+    try:
+        answers = _process_responder_api(responder_answer, request)['result']['items']
+    except UserException:
+        # The cursor has expired
+        del _answer_cursors[comm_id]
+        return
+    _answer_cursors[comm_id] = (cursor_id, offset + len(answers))
+    _previous_answers[comm_id].extend(answers)
+
+
 @needs_question
-def _next(user, comm_id, *args):
+def _next(user, comm_id, request=None, *args):
     next_answer = _last_answer[comm_id] + 1
+    if next_answer >= len(_previous_answers[comm_id]) and request is not None:
+        _fetch_more_answers(user, comm_id, request)
     if next_answer < len(_previous_answers[comm_id]):
         answer = _previous_answers[comm_id][next_answer]
         _last_answer[comm_id] = next_answer
@@ -177,6 +199,7 @@ def _answer(user, comm_id, request, question):
     request['args']['token'] = user.token
     request['args']['question'] = question
     request['args']['numberofitems'] = '5'
+    request['args']['cursor'] = 'true'
     try:
         response = _process_responder_api(responder_answer, request)
     except UserException as e:
@@ -184,6 +207,12 @@ def _answer(user, comm_id, request, question):
     if not response:
         return
     answers = response['result']['items']
+    cursor_id = response['result'].get('cursorId')
+    if cursor_id is not None:
+        _answer_cursors[comm_id] = (cursor_id, len(answers))
+    else:
+        # Cursors are disabled, never page through the previous question's answers
+        _answer_cursors.pop(comm_id, None)
     _previous_answers[comm_id] = answers
     _last_answer[comm_id] = 0
     _LAST_QUESTION[comm_id] = question
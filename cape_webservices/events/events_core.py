@@ -0,0 +1,162 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+
+from cape_userdb.base import DB
+from cape_userdb.event import Event
+from cape_userdb.coverage import Coverage
+from cape_webservices.events.events_models import EventCounter, EventSourceCounter, CoverageRollup, \
+    rebuild_inbox_counters, NEW_STATISTICS_TABLES
+
+COVERAGE_RESOLUTIONS = {
+    'hour': lambda time: time.replace(minute=0, second=0, microsecond=0),
+    'day': lambda time: time.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+# Truncated times of the coverage periods as stored in the rollups
+_COVERAGE_PERIOD_FORMATS = {'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'}
+# Same as event_source on an event row
+_EVENT_SOURCE = "CASE WHEN NOT event.answered THEN 'unanswered' " \
+                "WHEN json_extract(event.answers, '$[0].sourceType') = 'saved_reply' THEN 'saved_reply' " \
+                "ELSE json_extract(event.answers, '$[0].sourceId') END"
+
+
+def event_source(answered, answers) -> str:
+    """Source an event is counted under in the statistics."""
+    if not answered:
+        return 'unanswered'
+    if answers[0]['sourceType'] == 'saved_reply':
+        return 'saved_reply'
+    return answers[0]['sourceId']
+
+
+def _statistics_tables(where) -> dict:
+    return {'event': Event._meta.table_name, 'coverage': Coverage._meta.table_name,
+            'counter': EventCounter._meta.table_name, 'source_counter': EventSourceCounter._meta.table_name,
+            'rollup': CoverageRollup._meta.table_name, 'where': where, 'source': _EVENT_SOURCE}
+
+
+def _rebuild_event_counters(where, params):
+    tables = _statistics_tables(where)
+    DB.execute_sql('INSERT OR REPLACE INTO "{counter}" (user_id, total, automatic) '
+                   'SELECT user_id, COUNT(*), SUM(automatic != 0) FROM "{event}" {where} GROUP BY user_id'
+                   .format(**tables), params)
+    DB.execute_sql('DELETE FROM "{source_counter}" {where}'.format(**tables), params)
+    DB.execute_sql('INSERT INTO "{source_counter}" (user_id, source, total, duration) '
+                   'SELECT user_id, {source}, COUNT(*), SUM(duration) FROM "{event}" AS event {where} '
+                   'GROUP BY user_id, {source}'.format(**tables), params)
+
+
+def _rebuild_coverage_rollups(where, params):
+    tables = _statistics_tables(where)
+    DB.execute_sql('DELETE FROM "{rollup}" {where}'.format(**tables), params)
+    for resolution, period_format in _COVERAGE_PERIOD_FORMATS.items():
+        # SQLite takes the bare coverage column from the row with MAX(created), the latest of the period
+        DB.execute_sql('INSERT INTO "{rollup}" (user_id, resolution, period, coverage, samples) '
+                       'SELECT user_id, ?, period, coverage, samples FROM ('
+                       'SELECT user_id, strftime(?, created) AS period, coverage, MAX(created), '
+                       'COUNT(*) AS samples FROM "{coverage}" {where} GROUP BY user_id, period)'
+                       .format(**tables), [resolution, period_format] + params)
+
+
+def rebuild_event_statistics(user_id=None):
+    """Recompute the statistics maintained as events are stored from the Event and Coverage tables, for a user or for
+    all users. They are filled when their tables are created, run through manage_users.py -r to repair them."""
+    where, params = ('WHERE user_id = ?', [user_id]) if user_id is not None else ('', [])
+    with DB.atomic():
+        _rebuild_event_counters(where, params)
+        _rebuild_coverage_rollups(where, params)
+        rebuild_inbox_counters(user_id)
+
+
+def _backfill_event_statistics():
+    """Count the events and roll up the coverage stored before the statistics tables were created."""
+    if NEW_STATISTICS_TABLES & {EventCounter, EventSourceCounter}:
+        with DB.atomic():
+            _rebuild_event_counters('', [])
+    if CoverageRollup in NEW_STATISTICS_TABLES:
+        with DB.atomic():
+            _rebuild_coverage_rollups('', [])
+
+
+_backfill_event_statistics()
+
+
+def _count_events(user_id, events) -> EventCounter:
+    """Add new events of a user to their counters, must be called after saving them."""
+    sources = {}
+    for event in events:
+        source = event_source(event['answered'], event['answers'])
+        count, duration = sources.get(source, (0, 0))
+        sources[source] = (count + 1, duration + event['duration'])
+    automatic = sum(1 for event in events if event['automatic'])
+    with DB.atomic():
+        updated = EventCounter.update(total=EventCounter.total + len(events),
+                                      automatic=EventCounter.automatic + automatic) \
+            .where(EventCounter.user_id == user_id).execute()
+        if not updated:
+            # The counters of the events stored before the table existed were filled when it was created
+            EventCounter.create(user_id=user_id, total=len(events), automatic=automatic)
+        for source, (count, duration) in sources.items():
+            updated = EventSourceCounter.update(total=EventSourceCounter.total + count,
+                                                duration=EventSourceCounter.duration + duration) \
+                .where(EventSourceCounter.user_id == user_id, EventSourceCounter.source == source).execute()
+            if not updated:
+                EventSourceCounter.create(user_id=user_id, source=source, total=count, duration=duration)
+        return EventCounter.get(EventCounter.user_id == user_id)
+
+
+def _roll_up_coverage(user_id, coverage, time):
+    for resolution, truncate in COVERAGE_RESOLUTIONS.items():
+        period = truncate(time)
+        updated = CoverageRollup.update(coverage=coverage, samples=CoverageRollup.samples + 1) \
+            .where(CoverageRollup.user_id == user_id, CoverageRollup.resolution == resolution,
+                   CoverageRollup.period == period).execute()
+        if not updated:
+            CoverageRollup.create(user_id=user_id, resolution=resolution, period=period, coverage=coverage, samples=1)
+
+
+def _coverage(counter: EventCounter) -> float:
+    # Base line of 60% from MR plus proportion answered by saved replies
+    return 60 + (counter.automatic / counter.total) * 35
+
+
+def save_events(events):
+    """Insert events of any users with created times, updating their counters and coverage in one transaction."""
+    events_by_user = {}
+    for event in events:
+        events_by_user.setdefault(event['user_id'], []).append(event)
+    with DB.atomic():
+        Event.insert_many([{'modified': event['created'], **event} for event in events]).execute()
+        now = datetime.now()
+        coverages = {user_id: _coverage(_count_events(user_id, user_events))
+                     for user_id, user_events in events_by_user.items()}
+        Coverage.insert_many([{'user_id': user_id, 'coverage': coverage, 'created': now, 'modified': now}
+                              for user_id, coverage in coverages.items()]).execute()
+        for user_id, coverage in coverages.items():
+            _roll_up_coverage(user_id, coverage, now)
+
+
+def store_event(user_id, question, answers, question_source, answered, duration, automatic=False):
+    store_events(user_id, [{'question': question, 'answers': answers, 'question_source': question_source,
+                            'answered': answered, 'duration': duration, 'automatic': automatic}])
+
+
+def store_events(user_id, events):
+    """Same as store_event for many questions, with a single bulk insert and coverage update."""
+    if DB.is_closed():
+        DB.connect()
+    now = datetime.now()
+    save_events([{'user_id': user_id, 'created': now, **event} for event in events])
+    DB.close()
@@ -0,0 +1,60 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from cape_webservices.events.events_writer import event_writer
+
+
+class InboxFeed:
+    """Wakes up the requests waiting for new inbox events of a user as soon as the event writer stores them.
+
+    Only events written by this process are signalled, waiters should also poll the database."""
+
+    def __init__(self):
+        # user id -> futures of the requests waiting, only accessed from the event loop
+        self._waiters = {}
+        self._loop = None
+
+    async def wait(self, user_id, timeout: float):
+        """Return when new events of the user are written or after the timeout."""
+        self._loop = asyncio.get_event_loop()
+        waiter = self._loop.create_future()
+        self._waiters.setdefault(user_id, set()).add(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        finally:
+            user_waiters = self._waiters.get(user_id)
+            if user_waiters is not None:
+                user_waiters.discard(waiter)
+                if not user_waiters:
+                    del self._waiters[user_id]
+
+    def notify(self, user_ids):
+        """Called from any thread with the ids of the users who have new events."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake, user_ids)
+
+    def stats(self) -> dict:
+        return {'waiting': sum(len(waiters) for waiters in self._waiters.values())}
+
+    def _wake(self, user_ids):
+        for user_id in user_ids:
+            for waiter in self._waiters.pop(user_id, ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+
+inbox_feed = InboxFeed()
+event_writer.listeners.append(inbox_feed.notify)
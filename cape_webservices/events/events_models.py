@@ -0,0 +1,167 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from logging import warning
+
+from peewee import Model, CharField, IntegerField, FloatField, DateTimeField
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+from cape_userdb.base import DB
+from cape_userdb.event import Event
+
+
+class EventCounter(Model):
+    """Running number of events of each user, updated as events are stored."""
+    user_id = CharField(unique=True)
+    total = IntegerField(default=0)
+    automatic = IntegerField(default=0)
+
+    class Meta:
+        database = DB
+
+
+class EventSourceCounter(Model):
+    """Number and total duration of the events of each user by source of their first answer, updated as events are
+    stored. The source is a document id, 'saved_reply' or 'unanswered'."""
+    user_id = CharField()
+    source = CharField()
+    total = IntegerField(default=0)
+    duration = FloatField(default=0)
+
+    class Meta:
+        database = DB
+        indexes = ((('user_id', 'source'), True),)
+
+
+class CoverageRollup(Model):
+    """Latest coverage of each user in every hour or day, updated as coverage changes."""
+    user_id = CharField()
+    resolution = CharField()
+    period = DateTimeField()
+    coverage = FloatField()
+    samples = IntegerField(default=0)
+
+    class Meta:
+        database = DB
+        indexes = ((('user_id', 'resolution', 'period'), True),)
+
+
+# Filled by events_core from the events stored before they existed
+NEW_STATISTICS_TABLES = {model for model in (EventCounter, EventSourceCounter, CoverageRollup)
+                         if not model.table_exists()}
+DB.create_tables([EventCounter, EventSourceCounter, CoverageRollup], safe=True)
+# Inbox pages are read in (created, id) order for each user
+DB.execute_sql('CREATE INDEX IF NOT EXISTS event_user_id_created_id ON "%s" (user_id, created, id)' %
+               Event._meta.table_name)
+
+
+class EventSearch(FTS5Model):
+    """Full text index of the questions and first answers of the events not archived, kept in sync by triggers."""
+    rowid = RowIDField()
+    user_id = SearchField(unindexed=True)
+    question = SearchField()
+    answer = SearchField()
+
+    class Meta:
+        database = DB
+
+
+_EVENT_SEARCH_ROW = "new.id, new.user_id, new.question, " \
+                    "CASE WHEN json_valid(new.answers) THEN json_extract(new.answers, '$[0].answerText') END"
+_EVENT_SEARCH_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS {search}_insert AFTER INSERT ON "{event}" WHEN NOT new.archived BEGIN '
+    'INSERT INTO "{search}" (rowid, user_id, question, answer) VALUES ({row}); END',
+    'CREATE TRIGGER IF NOT EXISTS {search}_delete AFTER DELETE ON "{event}" BEGIN '
+    'DELETE FROM "{search}" WHERE rowid = old.id; END',
+    'CREATE TRIGGER IF NOT EXISTS {search}_update AFTER UPDATE ON "{event}" '
+    'WHEN old.archived IS NOT new.archived OR old.question IS NOT new.question OR old.answers IS NOT new.answers '
+    'BEGIN DELETE FROM "{search}" WHERE rowid = old.id; '
+    'INSERT INTO "{search}" (rowid, user_id, question, answer) SELECT {row} WHERE NOT new.archived; END',
+]
+
+
+def _create_event_search() -> bool:
+    if not EventSearch.fts5_installed():
+        warning("SQLite FTS5 is not available, inbox search will scan the events")
+        return False
+    backfill = not EventSearch.table_exists()
+    DB.create_tables([EventSearch], safe=True)
+    for trigger in _EVENT_SEARCH_TRIGGERS:
+        DB.execute_sql(trigger.format(search=EventSearch._meta.table_name, event=Event._meta.table_name,
+                                      row=_EVENT_SEARCH_ROW))
+    if backfill:
+        DB.execute_sql('INSERT INTO "{search}" (rowid, user_id, question, answer) SELECT {row} FROM "{event}" AS new '
+                       'WHERE NOT new.archived'.format(search=EventSearch._meta.table_name,
+                                                       event=Event._meta.table_name, row=_EVENT_SEARCH_ROW))
+    return True
+
+
+EVENT_SEARCH_ENABLED = _create_event_search()
+
+
+class InboxCounter(Model):
+    """Number of events, and of unread, unanswered and archived events in the inbox of each user, kept in sync by
+    triggers."""
+    user_id = CharField(unique=True)
+    total = IntegerField(default=0)
+    unread = IntegerField(default=0)
+    unanswered = IntegerField(default=0)
+    archived = IntegerField(default=0)
+
+    class Meta:
+        database = DB
+
+
+# Contribution of an event row to each inbox counter
+_INBOX_COUNTS = {
+    'unread': '(NOT {row}.archived AND NOT {row}.read)',
+    'unanswered': '(NOT {row}.archived AND NOT {row}.answered)',
+    'archived': '({row}.archived != 0)',
+}
+_INBOX_COUNTER_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS {counter}_insert AFTER INSERT ON "{event}" BEGIN '
+    'INSERT OR IGNORE INTO "{counter}" (user_id, total, unread, unanswered, archived) VALUES (new.user_id, 0, 0, 0, 0); '
+    'UPDATE "{counter}" SET total = total + 1, unread = unread + {unread_new}, '
+    'unanswered = unanswered + {unanswered_new}, archived = archived + {archived_new} WHERE user_id = new.user_id; END',
+    'CREATE TRIGGER IF NOT EXISTS {counter}_delete AFTER DELETE ON "{event}" BEGIN '
+    'UPDATE "{counter}" SET total = total - 1, unread = unread - {unread_old}, '
+    'unanswered = unanswered - {unanswered_old}, archived = archived - {archived_old} WHERE user_id = old.user_id; END',
+    'CREATE TRIGGER IF NOT EXISTS {counter}_update AFTER UPDATE ON "{event}" '
+    'WHEN old.read IS NOT new.read OR old.answered IS NOT new.answered OR old.archived IS NOT new.archived BEGIN '
+    'UPDATE "{counter}" SET unread = unread - {unread_old} + {unread_new}, '
+    'unanswered = unanswered - {unanswered_old} + {unanswered_new}, '
+    'archived = archived - {archived_old} + {archived_new} WHERE user_id = new.user_id; END',
+]
+
+
+def rebuild_inbox_counters(user_id=None):
+    """Recount the inbox of a user, or of all users, from the Event table."""
+    where, params = ('WHERE user_id = ?', [user_id]) if user_id is not None else ('', [])
+    DB.execute_sql('INSERT OR REPLACE INTO "{counter}" (user_id, total, unread, unanswered, archived) '
+                   'SELECT user_id, COUNT(*), SUM({unread}), SUM({unanswered}), SUM({archived}) '
+                   'FROM "{event}" AS event {where} GROUP BY user_id'
+                   .format(counter=InboxCounter._meta.table_name, event=Event._meta.table_name, where=where,
+                           **{name: count.format(row='event') for name, count in _INBOX_COUNTS.items()}), params)
+
+
+def _create_inbox_counters():
+    backfill = not InboxCounter.table_exists()
+    DB.create_tables([InboxCounter], safe=True)
+    counts = {f'{name}_{row}': count.format(row=row) for name, count in _INBOX_COUNTS.items() for row in ('old', 'new')}
+    for trigger in _INBOX_COUNTER_TRIGGERS:
+        DB.execute_sql(trigger.format(counter=InboxCounter._meta.table_name, event=Event._meta.table_name, **counts))
+    if backfill:
+        rebuild_inbox_counters()
+
+
+_create_inbox_counters()
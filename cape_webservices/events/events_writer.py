@@ -0,0 +1,155 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import time
+from datetime import datetime
+from threading import Condition, Thread
+from logging import warning
+
+from cape_userdb.base import DB
+from cape_webservices.events.events_core import save_events
+from cape_webservices.webservices_settings import EVENT_WRITER_BATCH_SIZE, EVENT_WRITER_FLUSH_INTERVAL, \
+    EVENT_WRITER_MAX_PENDING
+
+
+# Longest wait in seconds between attempts to write events while the database fails, and attempts made at exit
+_MAX_BACKOFF = 60
+_CLOSE_ATTEMPTS = 3
+
+
+class EventWriter:
+    """Buffers answer events in process and writes them in bulk from a background thread."""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._condition = Condition()
+        self._thread = None
+        self._closed = False
+        # Called from the writer thread with the ids of the users whose events were written
+        self.listeners = []
+        self.written = 0
+        self.dropped = 0
+        self.retries = 0
+
+    def write(self, user_id, question, answers, question_source, answered, duration, automatic=False):
+        """Queue an event, same arguments as store_event. Waits while too many events are pending, so it must not be
+        called from the event loop."""
+        event = {'user_id': user_id, 'question': question, 'answers': answers, 'question_source': question_source,
+                 'answered': answered, 'duration': duration, 'automatic': automatic, 'created': datetime.now()}
+        with self._condition:
+            self._start()
+            while not self._closed and len(self._pending) >= self.max_pending:
+                self._condition.wait()
+            if self._closed:
+                # Shutting down, nothing will flush the buffer anymore
+                self._pending.append(event)
+                self._flush()
+                return
+            self._pending.append(event)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def close(self):
+        """Write all pending events and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        with self._condition:
+            for attempt in range(_CLOSE_ATTEMPTS):
+                if self._flush():
+                    return
+                time.sleep(2 ** attempt)
+            # Last resort, the process is exiting and the database keeps failing
+            warning("Dropped %d events that could not be written at exit", len(self._pending))
+            self.dropped += len(self._pending)
+            self._pending = []
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'pending': len(self._pending), 'written': self.written, 'dropped': self.dropped,
+                    'retries': self.retries}
+
+    def _start(self):
+        # Started lazily so that each forked worker gets its own thread
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, name='event-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._condition:
+            backoff = 0
+            while not self._closed:
+                deadline = time.time() + max(self.flush_interval, backoff)
+                # Full batches don't cut the backoff short
+                while not self._closed and (backoff or len(self._pending) < self.batch_size) and \
+                        time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                if self._flush():
+                    backoff = 0
+                else:
+                    self.retries += 1
+                    backoff = min(_MAX_BACKOFF, max(self.flush_interval, backoff * 2))
+
+    def _flush(self) -> bool:
+        """Write the pending events, called with the condition held and released while writing.
+
+        Returns False when a batch could not be written, it is put back in front of the pending events to be retried
+        and writers keep waiting until it is.
+        """
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._condition.release()
+            try:
+                saved = self._save(batch)
+                if saved:
+                    self._notify({event['user_id'] for event in batch})
+            finally:
+                self._condition.acquire()
+            if not saved:
+                self._pending[:0] = batch
+                return False
+            self.written += len(batch)
+            self._condition.notify_all()
+        return True
+
+    def _notify(self, user_ids):
+        for listener in self.listeners:
+            try:
+                listener(user_ids)
+            except Exception:
+                warning("Event listener failed", exc_info=True)
+
+    @staticmethod
+    def _save(batch) -> bool:
+        try:
+            if DB.is_closed():
+                DB.connect()
+            save_events(batch)
+            return True
+        except Exception:
+            warning("Could not write %d events, they will be retried", len(batch), exc_info=True)
+            return False
+        finally:
+            DB.close()
+
+
+event_writer = EventWriter(EVENT_WRITER_BATCH_SIZE, EVENT_WRITER_FLUSH_INTERVAL, EVENT_WRITER_MAX_PENDING)
+atexit.register(event_writer.close)
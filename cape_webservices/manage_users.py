@@ -25,6 +25,11 @@ from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.text_responses import *
 from cape_document_manager.document_store import DocumentStore
 from cape_document_manager.annotation_store import AnnotationStore
+from cape_webservices.app.app_answer_cache import answer_cache
+from cape_webservices.app.app_content_totals import content_totals
+from cape_webservices.app.app_embedding_cache import embedding_cache
+from cape_webservices.events.events_models import EventCounter, EventSourceCounter, CoverageRollup, InboxCounter
+from cape_webservices.events.events_core import rebuild_event_statistics
 
 """
 Script to create, delete and reset buffer for users.
@@ -55,6 +60,10 @@ def delete_all_user_data(user_id):
     for annotation in annotations:
         AnnotationStore.delete_annotation(user.token, annotation['id'])
 
+    answer_cache.invalidate(user.token)
+    content_totals.invalidate(user.token)
+    embedding_cache.delete(user.token)
+
     user.delete_instance()
     info("User " + user_id + " data deleted successfully")
     info("Looking for session data")
@@ -82,6 +91,10 @@ def delete_all_user_data(user_id):
         coverage.delete_instance()
         del_counter += 1
     info("Deleted " + str(del_counter) + " coveragae entries")
+    EventCounter.delete().where(EventCounter.user_id == user_id).execute()
+    EventSourceCounter.delete().where(EventSourceCounter.user_id == user_id).execute()
+    InboxCounter.delete().where(InboxCounter.user_id == user_id).execute()
+    CoverageRollup.delete().where(CoverageRollup.user_id == user_id).execute()
     del_counter = 0
     email_events = EmailEvent.all('user_id', user_id)
     for event in email_events:
@@ -90,10 +103,24 @@ def delete_all_user_data(user_id):
     info("Deleted " + str(del_counter) + " email events")
 
 
+def rebuild_statistics(user_ids):
+    """Rebuild the statistics maintained as events are stored, for the given users or all users with events. Needed
+    once for the events stored before the statistics existed."""
+    if not user_ids:
+        rebuild_event_statistics()
+        info("Statistics of all users rebuilt")
+        return
+    for user_id in user_ids:
+        rebuild_event_statistics(user_id.lower())
+    info("Statistics of %d users rebuilt", len(user_ids))
+
+
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-c", "--create", dest="create", help="Create a user", action="store_true")
     parser.add_option("-d", "--delete", dest="delete", help="Delete a user", action="store_true")
+    parser.add_option("-r", "--rebuild-statistics", dest="rebuild", action="store_true",
+                      help="Rebuild the event statistics of the given users, or of all users")
 
     (options, args) = parser.parse_args()
     if options.create:
@@ -110,5 +137,7 @@ if __name__ == '__main__':
             print("Usage: manage_users.py -d <username>")
         else:
             delete_all_user_data(args[0])
+    elif options.rebuild:
+        rebuild_statistics(args)
     else:
         parser.print_help()
@@ -59,3 +59,11 @@ def cape_client_answer():
     client = _init_user('testuser_answer', 'testpass_answer', {})
     yield client
     client.logout()
+
+
+@pytest.fixture(scope="session")
+def cape_client_events():
+    # Tests answering many questions use their own user, test_client.test_inbox expects a short inbox
+    client = _init_user('testuser_events', 'testpass_events', {})
+    yield client
+    client.logout()
@@ -12,15 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import time
+import pytest
 import requests
+import tarfile
+import zipfile
+from io import BytesIO
+from hashlib import sha256
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 
 from cape_webservices.tests.tests_settings import URL
 
-# pytest automatically imports cape_client and cape_client_answer fixtures in conftest.py
+# pytest automatically imports cape_client, cape_client_answer and cape_client_events fixtures in conftest.py
 
 BASE_URL = URL + '/api/0.1'
 
 
+def _wait_for(condition, timeout=10):
+    """Poll condition until it returns a true value or the timeout expires, returning its last value."""
+    deadline = time.time() + timeout
+    result = condition()
+    while not result and time.time() < deadline:
+        time.sleep(0.1)
+        result = condition()
+    return result
+
+
+def _answer_and_wait(cape_client, questions):
+    """Answer the questions and wait for the background event writer to store them."""
+    url = BASE_URL + f'/user/stats-questions?adminToken={cape_client.get_admin_token()}&numberOfItems=1'
+    total = requests.get(url).json()['result']['totalItems']
+    for question in questions:
+        cape_client.answer(question)
+    assert _wait_for(lambda: requests.get(url).json()['result']['totalItems'] >= total + len(questions))
+
+
+def _all_stats_questions(admin_token):
+    questions = []
+    while True:
+        page = requests.get(BASE_URL + f'/user/stats-questions?adminToken={admin_token}&numberOfItems=100'
+                                       f'&offset={len(questions)}').json()['result']
+        questions.extend(page['items'])
+        if not page['items'] or len(questions) >= page['totalItems']:
+            return questions
+
+
 def test_api(cape_client):
     token = cape_client.get_user_token()
     response = requests.get(BASE_URL + '/test?token=' + token)
@@ -43,6 +81,7 @@ def test_answer(cape_client):
     print(response.json())
     assert response.status_code == 200
     assert response.json()['success'] is True
+    assert response.json()['result']['speedOrAccuracy'] in {'speed', 'balanced', 'accuracy', 'total'}
 
 
 def test_answer_inline(cape_client):
@@ -54,6 +93,145 @@ def test_answer_inline(cape_client):
     assert response.json()['success'] is True
 
 
+def test_answer_concurrent(cape_client_events):
+    token = cape_client_events.get_user_token()
+    url = BASE_URL + f'/answer?token={token}&sourceType=document&question=How many potatoes do you have?&text=I have 3 potatoes'
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        answers = executor.map(requests.get, [url] * 4)
+        status = requests.get(URL + '/status')
+        assert status.status_code == 200
+        for response in answers:
+            assert response.status_code == 200
+            assert response.json()['success'] is True
+
+
+def test_answer_concurrent_sources(cape_client_events):
+    token = cape_client_events.get_user_token()
+    response = requests.get(
+        BASE_URL + f'/answer?token={token}&concurrentSources=true&numberOfItems=3&question=How many potatoes do you have?&text=I have 3 potatoes')
+    assert response.status_code == 200
+    assert response.json()['success'] is True
+    confidences = [item['confidence'] for item in response.json()['result']['items']]
+    assert confidences == sorted(confidences, reverse=True)
+
+
+def test_answer_deadline(cape_client_events):
+    token = cape_client_events.get_user_token()
+    # Unique question so the answer can't come from the cache
+    response = requests.get(
+        BASE_URL + f'/answer?token={token}&deadlineMs=1&question=How many cherries do you have {uuid4()}?&text=I have 5 cherries')
+    assert response.status_code == 200
+    assert response.json()['success'] is True
+    assert response.json()['result']['partial'] is True
+    response = requests.get(BASE_URL + f'/answer?token={token}&deadlineMs=soon&question=How many cherries?')
+    assert response.status_code == 500
+    assert response.json()['success'] is False
+
+
+def test_answer_cursor(cape_client_events):
+    token = cape_client_events.get_user_token()
+    text = 'I have 3 potatoes. I have 2 carrots. I have 1 onion.'
+    response = requests.get(
+        BASE_URL + f'/answer?token={token}&cursor=true&numberOfItems=1&question=What do you have?&text={text}')
+    assert response.status_code == 200
+    first_page = response.json()['result']
+    assert len(first_page['items']) == 1
+    response = requests.get(
+        BASE_URL + f'/answer?token={token}&cursorId={first_page["cursorId"]}&offset=1&numberOfItems=1')
+    assert response.status_code == 200
+    second_page = response.json()['result']
+    assert second_page['totalItems'] == first_page['totalItems']
+    if first_page['totalItems'] > 1:
+        assert second_page['items'][0] != first_page['items'][0]
+    response = requests.get(BASE_URL + f'/answer?token={token}&cursorId=invalid')
+    assert response.status_code == 500
+    assert response.json()['success'] is False
+
+
+def test_answer_coalescing(cape_client_events):
+    token = cape_client_events.get_user_token()
+    url = BASE_URL + f'/answer?token={token}&sourceType=document&question=How many pears do you have {uuid4()}?&text=I have 6 pears'
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(requests.get, [url] * 4))
+    assert all(response.json()['success'] for response in responses)
+    assert len({json.dumps(response.json()['result']['items']) for response in responses}) == 1
+    status = requests.get(URL + '/status').json()
+    assert status['answerCoalescing']['inFlight'] == 0
+
+
+def test_answer_coalescing_deadline(cape_client_events):
+    token = cape_client_events.get_user_token()
+    url = BASE_URL + f'/answer?token={token}&sourceType=document&question=How many plums do you have {uuid4()}?&text=I have 4 plums'
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        short, full = executor.map(requests.get, [url + '&deadlineMs=1', url])
+    assert short.json()['success'] is True
+    assert full.json()['result']['partial'] is False
+
+
+def test_answer_cache(cape_client_events):
+    token = cape_client_events.get_user_token()
+    url = BASE_URL + f'/answer?token={token}&sourceType=document&question=How many apples do you have?&text=I have 4 apples'
+    first = requests.get(url)
+    hits = requests.get(URL + '/status').json()['answerCache']['hits']
+    second = requests.get(url)
+    assert requests.get(URL + '/status').json()['answerCache']['hits'] == hits + 1
+    assert first.json()['result'] == second.json()['result']
+
+
+def test_answer_stream(cape_client_events):
+    token = cape_client_events.get_user_token()
+    response = requests.get(
+        BASE_URL + f'/answer-stream?token={token}&numberOfItems=2&question=How many potatoes do you have?&text=I have 3 potatoes',
+        stream=True)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.iter_lines() if line]
+    assert lines[-1]['success'] is True and lines[-1]['done'] is True
+    assert lines[-1]['totalItems'] == len(lines) - 1
+    assert all('answerText' in line['answer'] for line in lines[:-1])
+
+
+def test_answer_batch(cape_client_events):
+    token = cape_client_events.get_user_token()
+    questions = ['How many potatoes do you have?', 'What do you have?']
+    response = requests.post(BASE_URL + f'/answer-batch?token={token}',
+                             json={'questions': questions, 'text': 'I have 3 potatoes', 'sourceType': 'document'})
+    assert response.status_code == 200
+    assert response.json()['success'] is True
+    items = response.json()['result']['items']
+    assert [item['question'] for item in items] == questions
+    assert all(len(item['answers']) == 1 for item in items)
+
+
+def test_answer_batch_invalid(cape_client):
+    token = cape_client.get_user_token()
+    response = requests.post(BASE_URL + f'/answer-batch?token={token}', json={'questions': 'not a list'})
+    assert response.status_code == 500
+    assert response.json()['success'] is False
+
+
+def test_event_writer(cape_client_events):
+    token = cape_client_events.get_user_token()
+    admin_token = cape_client_events.get_admin_token()
+    written = requests.get(URL + '/status').json()['eventWriter']['written']
+    questions = [f'Is {uuid4()} in the sky?' for _ in range(20)]
+    response = requests.post(BASE_URL + f'/answer-batch?token={token}', json={'questions': questions})
+    assert response.json()['success'] is True
+    assert _wait_for(lambda: requests.get(URL + '/status').json()['eventWriter']['written'] >= written + 20)
+    # All the events of the batch are stored in the same way as before
+    stored = requests.get(BASE_URL + f'/user/stats-questions?adminToken={admin_token}&numberOfItems=20').json()
+    assert {question['question'] for question in stored['result']['items']} == set(questions)
+
+
+def test_inline_text_cache(cape_client_events):
+    token = cape_client_events.get_user_token()
+    text = f'I have 7 bananas and my name is {uuid4()}'
+    requests.get(BASE_URL + f'/answer?token={token}&sourceType=document&question=How many bananas do you have?&text={text}')
+    hits = requests.get(URL + '/status').json()['inlineTextCache']['hits']
+    response = requests.get(BASE_URL + f'/answer?token={token}&sourceType=document&question=What is your name?&text={text}')
+    assert response.json()['success'] is True
+    assert requests.get(URL + '/status').json()['inlineTextCache']['hits'] == hits + 1
+
+
 def test_exception_token_answer(cape_client):
     token = cape_client.get_user_token()
     params = {'token': token,
@@ -103,3 +281,246 @@ def test_stats(cape_client):
     response = requests.get(BASE_URL + f'/user/stats?adminToken=' + admin_token)
     assert response.status_code == 200
     assert response.json()['success'] is True
+
+
+def test_stats_counters(cape_client_answer):
+    # This user's answers never come from annotations, which count as automatic in the coverage only
+    admin_token = cape_client_answer.get_admin_token()
+    total = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}').json()['result']['totalQuestions']
+    _answer_and_wait(cape_client_answer, [f'Is {uuid4()} in the sky?'])
+    stats = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}&resolution=hour').json()['result']
+    assert stats['totalQuestions'] == total + 1
+    # The counters give the values previously counted from the events
+    questions = _all_stats_questions(admin_token)
+    assert len(questions) == stats['totalQuestions']
+    automatic = sum(1 for question in questions if question['status'] == 'automatic')
+    assert stats['coverage'][-1]['coverage'] == pytest.approx(60 + automatic / len(questions) * 35)
+
+
+def test_stats_sources(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, [f'Is {uuid4()} in the sky?'])
+    stats = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}').json()['result']
+    # The source counters give the values previously computed from the events
+    questions = _all_stats_questions(admin_token)
+    for status in ['automatic', 'assisted', 'unanswered']:
+        assert stats[status] == sum(1 for question in questions if question['status'] == status)
+    duration = sum(question['duration'] for question in questions if question['status'] != 'unanswered')
+    assert stats['averageResponseTime'] == pytest.approx(duration / len(questions))
+    assert sum(source['percent'] for source in stats['sources']) == pytest.approx(100)
+
+
+def test_stats_content_totals(cape_client):
+    admin_token = cape_client.get_admin_token()
+    stats_url = BASE_URL + f'/user/stats?adminToken={admin_token}'
+    total = requests.get(stats_url).json()['result']['totalDocuments']
+    requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                  data={'title': 'Totals', 'text': 'The sky is blue.', 'documentId': 'totals', 'replace': 'true'})
+    assert requests.get(stats_url).json()['result']['totalDocuments'] == total + 1
+    requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}&documentId=totals')
+    assert requests.get(stats_url).json()['result']['totalDocuments'] == total
+
+
+def test_stats_coverage_resolution(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, ['What colour is the sky?'])
+    response = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}&resolution=hour&from=2018-01-01')
+    assert response.json()['success'] is True
+    coverage = response.json()['result']['coverage']
+    assert len(coverage) > 0
+    assert 0 < coverage[-1]['coverage'] <= 95
+    response = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}&to=2000-01-01')
+    assert response.json()['result']['coverage'] == []
+    response = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}&resolution=minute')
+    assert response.status_code == 500
+    assert response.json()['success'] is False
+
+
+def test_stats_questions(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, ['What colour is the sky?', 'How old is the universe?'])
+    stats = requests.get(BASE_URL + f'/user/stats?adminToken={admin_token}&numberOfItems=1').json()['result']
+    assert len(stats['questions']) == 1
+    assert stats['totalQuestions'] == stats['automatic'] + stats['assisted'] + stats['unanswered']
+    response = requests.get(BASE_URL + f'/user/stats-questions?adminToken={admin_token}&numberOfItems=1&offset=1')
+    assert response.json()['result']['totalItems'] == stats['totalQuestions']
+    assert len(response.json()['result']['items']) == 1
+    assert response.json()['result']['items'][0]['created'] <= stats['questions'][0]['created']
+
+
+def test_inbox_cursor(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, ['What colour is the sky?', 'How old is the universe?', 'Who are you?'])
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&numberOfItems=2')
+    first_page = response.json()['result']
+    assert len(first_page['items']) == 2
+    assert first_page['nextCursor'] is not None
+    _answer_and_wait(cape_client_events, ['Is this a new question?'])
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&numberOfItems=2&withTotal=false'
+                                       f'&cursor={first_page["nextCursor"]}')
+    second_page = response.json()['result']
+    assert 'totalItems' not in second_page
+    assert len(second_page['items']) > 0
+    first_ids = {item['id'] for item in first_page['items']}
+    assert all(item['id'] not in first_ids for item in second_page['items'])
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&cursor=invalid')
+    assert response.status_code == 500
+
+
+def test_inbox_search(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    word = uuid4().hex
+    _answer_and_wait(cape_client_events, [f'Is {word} in the sky?', f'Is {word} in the sky or {word} in the sea?'])
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&searchTerm={word[:8]}')
+    items = response.json()['result']['items']
+    assert len(items) == 2
+    assert items[0]['question'] == f'Is {word} in the sky or {word} in the sea?'
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&searchTerm={word}&numberOfItems=1')
+    first_page = response.json()['result']
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&searchTerm={word}&numberOfItems=1'
+                                       f'&cursor={first_page["nextCursor"]}')
+    assert response.json()['result']['items'][0]['id'] != first_page['items'][0]['id']
+
+
+def test_inbox_bulk(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, ['What colour is the sky?', 'How old is the universe?'])
+    items = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&read=false').json()['result']['items']
+    inbox_ids = json.dumps([item['id'] for item in items[:2]])
+    response = requests.get(BASE_URL + f'/inbox/bulk-mark-inbox-read?adminToken={admin_token}&inboxIds={inbox_ids}')
+    assert response.json()['result']['updated'] == 2
+    response = requests.get(BASE_URL + f'/inbox/bulk-mark-inbox-read?adminToken={admin_token}&inboxIds={inbox_ids}')
+    assert response.json()['result']['updated'] == 0
+    response = requests.get(BASE_URL + f'/inbox/bulk-archive-inbox?adminToken={admin_token}&read=true')
+    assert response.json()['result']['updated'] >= 2
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&read=true')
+    assert response.json()['result']['totalItems'] == 0
+    response = requests.get(BASE_URL + f'/inbox/bulk-archive-inbox?adminToken={admin_token}&inboxIds=notalist')
+    assert response.status_code == 500
+
+
+def test_inbox_counts(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    _answer_and_wait(cape_client_events, ['What colour is the sky?'])
+    counts = requests.get(BASE_URL + f'/inbox/get-inbox-counts?adminToken={admin_token}').json()['result']
+    assert counts['unread'] > 0
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&read=false&numberOfItems=1')
+    assert response.json()['result']['totalItems'] == counts['unread']
+    response = requests.get(BASE_URL + f'/inbox/get-inbox?adminToken={admin_token}&numberOfItems=1')
+    assert response.json()['result']['totalItems'] == counts['total'] - counts['archived']
+    requests.get(BASE_URL + f'/inbox/bulk-mark-inbox-read?adminToken={admin_token}')
+    counts = requests.get(BASE_URL + f'/inbox/get-inbox-counts?adminToken={admin_token}').json()['result']
+    assert counts['unread'] == 0
+
+
+def test_inbox_wait(cape_client_events):
+    admin_token = cape_client_events.get_admin_token()
+    response = requests.get(BASE_URL + f'/inbox/wait-inbox?adminToken={admin_token}&timeout=0')
+    assert response.json()['result']['items'] == []
+    since = response.json()['result']['since']
+    question = f'Is {uuid4()} in the sky?'
+    with ThreadPoolExecutor(1) as executor:
+        waiting = executor.submit(requests.get, BASE_URL + f'/inbox/wait-inbox?adminToken={admin_token}&since={since}')
+        cape_client_events.answer(question)
+        response = waiting.result()
+    assert [item['question'] for item in response.json()['result']['items']] == [question]
+    assert int(response.json()['result']['since']) > int(since)
+
+
+def test_upload_document_stream(cape_client):
+    admin_token = cape_client.get_admin_token()
+    text = f'The sky in {uuid4()} is blue. ' * 10000
+    chunks = (text[start:start + 65536].encode('utf-8') for start in range(0, len(text), 65536))
+    response = requests.post(BASE_URL + f'/documents/upload-document?adminToken={admin_token}&title=Streamed',
+                             data=chunks)
+    assert response.json()['success'] is True
+    document_id = response.json()['result']['documentId']
+    assert document_id == sha256(text.encode('utf-8')).hexdigest()
+    response = requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}&documentId={document_id}')
+    assert response.json()['success'] is True
+
+
+def test_document_job(cape_client):
+    admin_token = cape_client.get_admin_token()
+    response = requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                             data={'title': 'Background', 'text': 'The sea is blue.', 'documentId': 'background',
+                                   'replace': 'true', 'background': 'true'})
+    job_id = response.json()['result']['jobId']
+    assert response.json()['result']['documentId'] == 'background'
+    for _ in range(60):
+        job = requests.get(BASE_URL + f'/documents/get-document-job?adminToken={admin_token}&jobId={job_id}').json()
+        if job['result']['status'] not in ('queued', 'processing'):
+            break
+        time.sleep(1)
+    assert job['result']['status'] == 'done'
+    assert job['result']['chunksEmbedded'] > 0
+    assert job['result']['chunksTotal'] == job['result']['chunksEmbedded'] + job['result']['chunksReused']
+    response = requests.get(BASE_URL + f'/documents/get-document-job?adminToken={admin_token}&jobId=invalid')
+    assert response.status_code == 500
+
+
+def test_add_documents(cape_client):
+    admin_token = cape_client.get_admin_token()
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        zip_file.writestr('sea.txt', 'The sea is blue.')
+        zip_file.writestr('grass.txt', 'The grass is green.')
+    files = [('file', ('sky.txt', b'The sky is blue.')), ('file', ('archive.zip', archive.getvalue())),
+             ('file', ('binary.txt', b'\xff\xfe\xfa'))]
+    response = requests.post(BASE_URL + f'/documents/add-documents?adminToken={admin_token}',
+                             files=files, data={'replace': 'true'})
+    result = response.json()['result']
+    assert result['totalItems'] == 4
+    assert result['imported'] == 3
+    assert [item['title'] for item in result['items'] if not item['success']] == ['binary.txt']
+    for item in result['items']:
+        if item['success']:
+            requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}'
+                                    f'&documentId={item["documentId"]}')
+
+
+def test_add_documents_background(cape_client):
+    admin_token = cape_client.get_admin_token()
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar_file:
+        content = f'The sand in {uuid4()} is yellow.'.encode('utf-8')
+        info = tarfile.TarInfo('sand.txt')
+        info.size = len(content)
+        tar_file.addfile(info, BytesIO(content))
+    response = requests.post(BASE_URL + f'/documents/add-documents?adminToken={admin_token}',
+                             files=[('file', ('archive.tar.gz', archive.getvalue()))],
+                             data={'replace': 'true', 'background': 'true'})
+    item = response.json()['result']['items'][0]
+    assert item['success'] is True
+    job_url = BASE_URL + f'/documents/get-document-job?adminToken={admin_token}&jobId={item["jobId"]}'
+    assert _wait_for(lambda: requests.get(job_url).json()['result']['status'] == 'done')
+    requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}&documentId={item["documentId"]}')
+
+
+def test_embedding_cache(cape_client):
+    admin_token = cape_client.get_admin_token()
+    text = f'The sky in {uuid4()} is blue.'
+    requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                  data={'title': 'First', 'text': text, 'documentId': 'first', 'replace': 'true'})
+    hits = requests.get(URL + '/status').json()['embeddingCache']['hits']
+    response = requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                             data={'title': 'Second', 'text': text, 'documentId': 'second', 'replace': 'true'})
+    assert response.json()['success'] is True
+    assert requests.get(URL + '/status').json()['embeddingCache']['hits'] > hits
+    for document_id in ['first', 'second']:
+        requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}&documentId={document_id}')
+
+
+def test_replace_document_chunks(cape_client):
+    admin_token = cape_client.get_admin_token()
+    text = ' '.join(f'Sentence {index} of {uuid4()} is about the sky.' for index in range(400))
+    response = requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                             data={'title': 'Long', 'text': text, 'documentId': 'long', 'replace': 'true'})
+    assert response.json()['result']['chunksReused'] == 0
+    response = requests.post(BASE_URL + f'/documents/add-document?adminToken={admin_token}',
+                             data={'title': 'Long', 'text': text + ' The sea is green.', 'documentId': 'long',
+                                   'replace': 'true'})
+    result = response.json()['result']
+    assert result['chunksReused'] > 0
+    assert result['chunksEmbedded'] < result['chunksReused']
+    requests.get(BASE_URL + f'/documents/delete-document?adminToken={admin_token}&documentId=long')
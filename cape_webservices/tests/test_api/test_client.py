@@ -290,6 +290,18 @@ def test_answer(cape_client):
     assert answers[0]['answerText'] == 'blue'
 
 
+def test_answer_cache_invalidation(cape_client):
+    for document in cape_client.get_documents()['items']:
+        cape_client.delete_document(document['id'])
+    cape_client.upload_document(title='Sky', text='The sky is blue.', document_id='sky', replace=True)
+    answers = cape_client.answer('What colour is the sky?', source_type="document")
+    assert answers[0]['answerText'] == 'blue'
+    cape_client.upload_document(title='Sky', text='The sky is grey.', document_id='sky', replace=True)
+    answers = cape_client.answer('What colour is the sky?', source_type="document")
+    assert answers[0]['answerText'] == 'grey'
+    cape_client.delete_document('sky')
+
+
 def test_answer_inline(cape_client):
     documents = cape_client.get_documents()['items']
     for document in documents:
@@ -327,9 +339,12 @@ def test_inbox(cape_client):
     events = cape_client.get_inbox()['items']
     assert len(events) == 0
     cape_client.answer('What colour is the sky?')
-    # HACK: Saving inbox events is sent to a worker and doesn't block, so we can't know for sure when it finishes
-    time.sleep(1)
+    # Inbox events are written in the background, wait for the writer to store this one
+    deadline = time.time() + 10
     events = cape_client.get_inbox()['items']
+    while not events and time.time() < deadline:
+        time.sleep(0.1)
+        events = cape_client.get_inbox()['items']
     item = events[0]
     assert len(events) == 1
     events = cape_client.get_inbox(read=True)['items']
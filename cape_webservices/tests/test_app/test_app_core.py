@@ -0,0 +1,27 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cape_webservices.app import app_core
+from cape_webservices.app.app_answer_cache import AnswerCursors
+
+
+def test_answer_cursor_disabled(monkeypatch):
+    results = [{'text': str(index), 'confidence': 1 - index / 10} for index in range(5)]
+    parameters = {'user_token': 'token', 'speed_or_accuracy': 'speed'}
+    for max_size, ttl in [(0, 600), (10, 0)]:
+        monkeypatch.setattr(app_core, 'answer_cursors', AnswerCursors(max_size, ttl))
+        response = app_core._answer_response({'args': {'cursor': 'true'}}, parameters, results, False, 2, 2)
+        assert response['items'] == results[2:4]
+        assert response['totalItems'] == 5
+        assert 'cursorId' not in response
@@ -23,6 +23,7 @@ from cape_webservices.app.app_document_endpoints import app_document_endpoints
 from cape_webservices.app.app_saved_reply_endpoints import app_saved_reply_endpoints
 from cape_webservices.app.app_inbox_endpoints import app_inbox_endpoints
 from cape_webservices.app.app_user_endpoints import app_user_endpoints
+from cape_webservices.events.events_writer import event_writer
 from cape_webservices import webservices_settings
 
 app = Sanic(__name__)
@@ -81,6 +82,11 @@ app.config.update(webservices_settings.WEBAPP_CONFIG)
 info(f"List of active endpoints { app.router.routes_all.keys() }")
 
 
+@app.listener('after_server_stop')
+async def _flush_events(app, loop):
+    event_writer.close()
+
+
 def run(port: Union[None, int] = None):
     if port is not None:
         webservices_settings.CONFIG_SERVER['port'] = int(port)
@@ -66,14 +66,82 @@ WEBAPP_CONFIG = dict(
     WEBSOCKET_MAX_QUEUE=envint("CAPE_WEBSERVICE_WEBSOCKET_MAX_QUEUE", 32)
 )
 MAX_NUMBER_OF_ANSWERS = envint("CAPE_WEBSERVICE_MAX_NUM_ANSWERS", 50)
+# Threads answering questions outside of the event loop, twice as many wait on their responder calls, answers get no
+# more results once those are all taken by calls that outlived their deadline
+ANSWER_EXECUTOR_THREADS = envint("CAPE_WEBSERVICE_ANSWER_THREADS", 32)
+# Maximum number of /answer results kept in memory, 0 disables the cache
+ANSWER_CACHE_MAX_SIZE = envint("CAPE_WEBSERVICE_ANSWER_CACHE_SIZE", 10000)
+# Number of answer cursors kept and their time to live in seconds
+ANSWER_CURSOR_MAX_SIZE = envint("CAPE_WEBSERVICE_ANSWER_CURSOR_SIZE", 10000)
+ANSWER_CURSOR_TTL = envint("CAPE_WEBSERVICE_ANSWER_CURSOR_TTL", 600)
+# Default of the concurrentSources parameter, true searches saved replies and documents at the same time
+ANSWER_CONCURRENT_SOURCES = os.getenv("CAPE_WEBSERVICE_ANSWER_CONCURRENT_SOURCES", "false").lower() == "true"
+# Confidence saved replies need to skip the document search when searching concurrently
+SAVED_REPLY_SHORTCUT_CONFIDENCE = float(os.getenv("CAPE_WEBSERVICE_SAVED_REPLY_SHORTCUT_CONFIDENCE", 0.9))
+# Answers in flight and average responder latency (in seconds) above which speedOrAccuracy is stepped down
+ANSWER_MAX_IN_FLIGHT = envint("CAPE_WEBSERVICE_ANSWER_MAX_IN_FLIGHT", 16)
+ANSWER_TARGET_LATENCY = float(os.getenv("CAPE_WEBSERVICE_ANSWER_TARGET_LATENCY", 5))
+# Lowest speedOrAccuracy mode each plan can be stepped down to
+SPEED_OR_ACCURACY_PLAN_FLOORS = {'free': 'speed', 'basic': 'balanced', 'pro': 'accuracy'}
+# Default time given to answer a question for each plan, requests can lower it with deadlineMs
+ANSWER_MAX_DEADLINE_MS = WEBAPP_CONFIG['REQUEST_TIMEOUT'] * 1000
+ANSWER_PLAN_DEADLINES_MS = {
+    'free': envint("CAPE_WEBSERVICE_FREE_DEADLINE_MS", 30000),
+    'basic': envint("CAPE_WEBSERVICE_BASIC_DEADLINE_MS", 60000),
+    'pro': envint("CAPE_WEBSERVICE_PRO_DEADLINE_MS", 120000),
+}
+MAX_BATCH_QUESTIONS = envint("CAPE_WEBSERVICE_MAX_BATCH_QUESTIONS", 500)
+# Threads answering the questions of /answer-batch, apart from the ones of the other answer endpoints
+ANSWER_BATCH_THREADS = envint("CAPE_WEBSERVICE_ANSWER_BATCH_THREADS", 8)
+# Answer events are written in the background in batches of this size or after this interval in seconds, requests
+# wait while this many are pending
+EVENT_WRITER_BATCH_SIZE = envint("CAPE_WEBSERVICE_EVENT_WRITER_BATCH_SIZE", 500)
+EVENT_WRITER_FLUSH_INTERVAL = float(os.getenv("CAPE_WEBSERVICE_EVENT_WRITER_FLUSH_INTERVAL", 1))
+EVENT_WRITER_MAX_PENDING = envint("CAPE_WEBSERVICE_EVENT_WRITER_MAX_PENDING", 10000)
+# Users whose number of saved replies and documents is kept in memory for /user/stats, 0 disables the cache
+CONTENT_TOTALS_CACHE_SIZE = envint("CAPE_WEBSERVICE_CONTENT_TOTALS_CACHE_SIZE", 10000)
+# Most recent coverage points returned by /user/stats at any resolution
+STATS_MAX_COVERAGE_POINTS = envint("CAPE_WEBSERVICE_STATS_MAX_COVERAGE_POINTS", 1000)
+# Longest time in seconds /inbox/wait-inbox holds a request, checking the database for events written by other
+# processes at every poll interval
+INBOX_WAIT_MAX_TIMEOUT = envint("CAPE_WEBSERVICE_INBOX_WAIT_MAX_TIMEOUT", 30)
+INBOX_WAIT_POLL_INTERVAL = float(os.getenv("CAPE_WEBSERVICE_INBOX_WAIT_POLL_INTERVAL", 5))
 HOSTNAME = os.getenv('CAPE_HOSTNAME', "DEV_SERVER")
 
 # FILE configuration
 THIS_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 STATIC_FOLDER = os.path.join(THIS_FOLDER, 'static')
 HTML_INDEX_STATIC_FILE = os.path.join(STATIC_FOLDER, 'index.html')
+# Chunk embeddings are stored by content hash so identical chunks are only embedded once, per user or shared by all
+# users, an empty path disables the cache
+EMBEDDING_CACHE_SQLITE_PATH = os.getenv('CAPE_WEBSERVICE_EMBEDDING_CACHE_SQLITE_PATH',
+                                        os.path.join(THIS_FOLDER, 'storage', 'embeddings.sqlite'))
+EMBEDDING_CACHE_SHARED = os.getenv('CAPE_WEBSERVICE_EMBEDDING_CACHE_SHARED', 'false').lower() == 'true'
+# Embedding model the cached chunks belong to, the installed cape_responder version when empty
+EMBEDDING_CACHE_MODEL = os.getenv('CAPE_WEBSERVICE_EMBEDDING_CACHE_MODEL', '')
 
 MAX_SIZE_INLINE_TEXT = envint("CAPE_WEBSERVICE_MAX_SIZE_INLINE_TEXT", int(1.5e5))  # in number of characters
+# Processed inline texts are kept for reuse up to this total number of characters (0 disables), and TTL in seconds
+INLINE_TEXT_CACHE_MAX_CHARS = envint("CAPE_WEBSERVICE_INLINE_TEXT_CACHE_MAX_CHARS", int(1.5e7))
+INLINE_TEXT_CACHE_TTL = envint("CAPE_WEBSERVICE_INLINE_TEXT_CACHE_TTL", 3600)
+# Streamed document uploads are kept in memory up to this number of bytes, and spooled to a temporary file above it
+DOCUMENT_UPLOAD_SPOOL_SIZE = envint("CAPE_WEBSERVICE_DOCUMENT_UPLOAD_SPOOL_SIZE", int(1e7))
+# Threads splitting and embedding documents added in the background, documents waiting for them and finished jobs
+# whose status is kept
+DOCUMENT_JOB_WORKERS = envint("CAPE_WEBSERVICE_DOCUMENT_JOB_WORKERS", 2)
+DOCUMENT_JOB_QUEUE_SIZE = envint("CAPE_WEBSERVICE_DOCUMENT_JOB_QUEUE_SIZE", 100)
+DOCUMENT_JOB_HISTORY = envint("CAPE_WEBSERVICE_DOCUMENT_JOB_HISTORY", 1000)
+# Texts of the documents waiting for the background threads are kept in memory up to this number of bytes each, and
+# spooled to temporary files above it
+DOCUMENT_JOB_SPOOL_SIZE = envint("CAPE_WEBSERVICE_DOCUMENT_JOB_SPOOL_SIZE", int(1e6))
+# Documents of a bulk import created concurrently, so their embeddings are spread over the responder workers, and
+# maximum number of documents and uncompressed bytes per import, checked from the archive headers before extracting
+DOCUMENT_IMPORT_THREADS = envint("CAPE_WEBSERVICE_DOCUMENT_IMPORT_THREADS", 8)
+DOCUMENT_IMPORT_MAX_FILES = envint("CAPE_WEBSERVICE_DOCUMENT_IMPORT_MAX_FILES", 10000)
+DOCUMENT_IMPORT_MAX_SIZE = envint("CAPE_WEBSERVICE_DOCUMENT_IMPORT_MAX_SIZE", int(200e6))
+# Imports above this number of uncompressed bytes return once extracted, their documents are created in the background
+# by the import threads
+DOCUMENT_IMPORT_BACKGROUND_SIZE = envint("CAPE_WEBSERVICE_DOCUMENT_IMPORT_BACKGROUND_SIZE", int(10e6))
 
 SUPER_ADMIN_TOKEN = "REPLACEME"
 
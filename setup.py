@@ -41,6 +41,7 @@ setup(
         'Authomatic==0.1.0.post1',
         'beautifulsoup4==4.6.0',
         'markdown==2.6.11',
+        'numpy==1.14.5',
         'peewee==3.5.2',
         'pytest==3.6.4',
         'requests==2.18.1',